@@ -1,7 +1,20 @@
 from __future__ import absolute_import, print_function
 
+import array
+import binascii
+import bisect
 import collections
 import contextlib
+import errno
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import re
+import sre_constants
+import sre_parse
+import struct
 import sys
 
 import pygit2
@@ -9,18 +22,23 @@ import pygit2
 from mercurial.i18n import _
 
 from mercurial import (
+    ancestor as ancestormod,
     changelog,
     color,
     context,
     dirstate as dirstatemod,
     dagop,
+    discovery,
     encoding,
     error,
+    lock as lockmod,
+    logcmdutil,
     match as matchmod,
     namespaces,
     node,
     pathutil,
     pycompat,
+    registrar,
     revset,
     revsetlang,
     scmutil,
@@ -28,14 +46,18 @@ from mercurial import (
     templatekw,
     util,
     vfs as vfsmod,
+    worker,
 )
 
+from mercurial.thirdparty.concurrent import futures
+
 from mercurial.node import (
     nullid,
     nullrev,
 )
 
 from mercurial.utils import (
+    dateutil,
     stringutil,
 )
 
@@ -49,65 +71,1863 @@ propertycache = util.propertycache
 namespace = namespaces.namespace
 tolist = namespaces.tolist
 
+cmdtable = {}
+command = registrar.command(cmdtable)
+
+configtable = {}
+configitem = registrar.configitem(configtable)
+
+# number of decoded commits to keep in memory
+configitem('gilded', 'revision-cache-size',
+    default=10000,
+)
+# narrow down desc(), grep() and keyword() with a trigram index
+configitem('gilded', 'text-index',
+    default=False,
+)
+# only look at the files watchman reports as changed in status
+configitem('gilded', 'fsmonitor',
+    default=False,
+)
+# number of workers hashing file contents (0 means one per cpu)
+configitem('gilded', 'hash-workers',
+    default=0,
+)
+# hash file contents in worker processes instead of threads
+configitem('gilded', 'hash-processes',
+    default=False,
+)
+# hash the files whose stat data is stale on the workers in status, instead
+# of one at a time in libgit2
+configitem('gilded', 'hash-status',
+    default=False,
+)
+# include remote-tracking branches, as <remote>/<branch>, in the branchmap
+configitem('gilded', 'remote-branches',
+    default=False,
+)
+
 # -- General pygit2 utilities
 
-class OidProxy(object):
+class OidProxy(int):
     """
-    Make a pygit2.Oid behave more like an int
+    A revision number which also carries the pygit2.Oid of its commit.
+
+    The integer value is the stable revision assigned by gitrevindex, so
+    proxies compare, hash and sort exactly like mercurial's integer revs.
     """
-    __slots__ = ('id', 'sortid')
-    def __init__(self, oid, sortid=0):
+    __slots__ = ('id',)
+
+    def __new__(cls, oid, rev):
+        self = super(OidProxy, cls).__new__(cls, rev)
         self.id = oid
-        self.sortid = sortid
+        return self
 
     def __repr__(self):
-        return '%s(%r, %d)' % (self.__class__.__name__, self.id, self.sortid)
+        return '%s(%r, %d)' % (self.__class__.__name__, self.id, self)
+
+    def __hex__(self):
+        return hex(self.id)
+
+def oid(rev):
+    return getattr(rev, 'id', rev)
+
+def branches_with(repo, revs):
+    # type: (gitrepository, Iterable[int]) -> List[int]
+    """
+    Return the revisions of the branch tips which contain any of revs.
+
+    Rather than testing every branch, the tips are looked up among the
+    descendants of revs, walked from the children index. Branch tips come
+    from the ref snapshot, which is read again whenever the refs change.
+    """
+    cl = repo.changelog
+    refs = repo.refsnapshot()
+    tips = set()
+    for prefix in ('refs/heads/', 'refs/remotes/'):
+        for tip in refs.commits(prefix).itervalues():
+            try:
+                tips.add(cl.rev(tip))
+            except error.LookupError:
+                continue
+    revs = list(revs)
+    if not tips or not revs:
+        return []
+    # descendants above the highest tip cannot lead to one
+    within = smartset.spanset(repo, 0, max(tips) + 1)
+    descendants = gitbitmapset(cl._childindex().descendants(revs, within))
+    return sorted(t for t in tips if t in descendants)
+
+def reftips(repo):
+    # type: (gitrepository) -> List[pygit2.Oid]
+    """
+    Return the commits pointed to by every ref, and by HEAD
+    """
+    return repo.refsnapshot().tips()
+
+def branchtips(repo):
+    # type: (gitrepository) -> List[pygit2.Oid]
+    """
+    Return the commits pointed to by the local branches
+    """
+    return repo.refsnapshot().commits('refs/heads/').values()
 
-    def __str__(self):
-        return str(self.id)
+# -- Commit-graph
+
+# see Documentation/technical/commit-graph-format.txt in git
+_GRAPH_PARENT_NONE = 0x70000000
+_GRAPH_EXTRA_EDGES = 0x80000000
+_GRAPH_LAST_EDGE = 0x80000000
+_GRAPH_DATA_WIDTH = 20 + 16
+
+class gitcommitgraphlayer(object):
+    """
+    A single memory-mapped commit-graph file
+    """
+    def __init__(self, path, base):
+        # type: (str, int) -> None
+        with open(path, 'rb') as f:
+            self.data = data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # only version 1 files with SHA-1 hashes are understood
+        if data[:4] != b'CGPH' or data[4:6] != b'\x01\x01':
+            raise ValueError('unsupported commit-graph: %s' % path)
+        nchunks = ord(data[6])
+        chunks = {}
+        for i in xrange(nchunks):
+            chunkid, offset = struct.unpack_from('>4sQ', data, 8 + 12 * i)
+            chunks[chunkid] = offset
+        self.fanout = chunks['OIDF']
+        self.lookup = chunks['OIDL']
+        self.commitdata = chunks['CDAT']
+        self.edges = chunks.get('EDGE')
+        self.count = struct.unpack_from('>I', data, self.fanout + 255 * 4)[0]
+        # number of commits in the layers below this one
+        self.base = base
+
+    def find(self, raw):
+        # type: (bytes) -> Optional[int]
+        """Return the position of a commit within this layer, or None"""
+        data = self.data
+        first = ord(raw[0])
+        if first:
+            lo = struct.unpack_from('>I', data, self.fanout + 4 * (first - 1))[0]
+        else:
+            lo = 0
+        hi = struct.unpack_from('>I', data, self.fanout + 4 * first)[0]
+        lookup = self.lookup
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = lookup + 20 * mid
+            cur = data[offset:offset + 20]
+            if cur < raw:
+                lo = mid + 1
+            elif cur > raw:
+                hi = mid
+            else:
+                return mid
+        return None
+
+
+class gitcommitgraph(object):
+    """
+    Read-only access to git's commit-graph file, or to a commit-graph chain.
+
+    Commits are addressed by their position in the graph. Positions are
+    global across the layers of a chain, with the base layer first, which
+    is also how the graph stores parent edges.
+    """
+    def __init__(self, layers):
+        # type: (List[gitcommitgraphlayer]) -> None
+        self.layers = layers
 
-    def __eq__(self, other):
+    @classmethod
+    def load(cls, gitdir):
+        # type: (str) -> Optional[gitcommitgraph]
+        """Return the commit-graph of a repository, or None if it has none"""
+        infodir = os.path.join(gitdir, 'objects', 'info')
+        paths = []
+        single = os.path.join(infodir, 'commit-graph')
+        if os.path.isfile(single):
+            paths.append(single)
+        else:
+            graphdir = os.path.join(infodir, 'commit-graphs')
+            try:
+                with open(os.path.join(graphdir, 'commit-graph-chain')) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            paths.append(os.path.join(graphdir,
+                                                      'graph-%s.graph' % line))
+            except IOError:
+                pass
+        if not paths:
+            return None
+        layers = []
+        base = 0
         try:
-            return self.id == other.id
-        except AttributeError:
-            return self.id == other
+            for path in paths:
+                layer = gitcommitgraphlayer(path, base)
+                layers.append(layer)
+                base += layer.count
+        except (IOError, OSError, ValueError, KeyError, struct.error):
+            # missing, truncated or unsupported: fall back to the odb
+            return None
+        return cls(layers)
 
-    def __lt__(self, other):
-        return self.sortid < int(other)
+    def __len__(self):
+        return sum(layer.count for layer in self.layers)
+
+    def _layer(self, pos):
+        # type: (int) -> gitcommitgraphlayer
+        for layer in self.layers:
+            if pos < layer.base + layer.count:
+                return layer
+        raise IndexError(pos)
+
+    def position(self, raw):
+        # type: (bytes) -> Optional[int]
+        """Return the global position of a commit, or None"""
+        for layer in self.layers:
+            pos = layer.find(raw)
+            if pos is not None:
+                return layer.base + pos
+        return None
+
+    def node(self, pos):
+        # type: (int) -> bytes
+        layer = self._layer(pos)
+        offset = layer.lookup + 20 * (pos - layer.base)
+        return layer.data[offset:offset + 20]
+
+    def parents(self, pos):
+        # type: (int) -> List[int]
+        """Return the positions of the parents of a commit"""
+        layer = self._layer(pos)
+        data = layer.data
+        offset = layer.commitdata + _GRAPH_DATA_WIDTH * (pos - layer.base)
+        p1, p2 = struct.unpack_from('>II', data, offset + 20)
+        if p1 == _GRAPH_PARENT_NONE:
+            return []
+        parents = [p1]
+        if p2 == _GRAPH_PARENT_NONE:
+            return parents
+        if not p2 & _GRAPH_EXTRA_EDGES:
+            parents.append(p2)
+            return parents
+        # octopus merge: the remaining parents are in the extra edge list
+        edge = layer.edges + 4 * (p2 & 0x7fffffff)
+        while True:
+            p = struct.unpack_from('>I', data, edge)[0]
+            parents.append(p & 0x7fffffff)
+            if p & _GRAPH_LAST_EDGE:
+                return parents
+            edge += 4
+
+    def parentnodes(self, raw):
+        # type: (bytes) -> Optional[List[bytes]]
+        """Return the parents of a commit as raw nodes, or None if the
+        commit is not in the graph"""
+        pos = self.position(raw)
+        if pos is None:
+            return None
+        return [self.node(p) for p in self.parents(pos)]
 
-    def __le__(self, other):
-        return self.sortid <= int(other)
+    def _times(self, pos):
+        layer = self._layer(pos)
+        offset = layer.commitdata + _GRAPH_DATA_WIDTH * (pos - layer.base)
+        return struct.unpack_from('>II', layer.data, offset + 28)
 
-    def __gt__(self, other):
-        return self.sortid > int(other)
+    def committime(self, pos):
+        # type: (int) -> int
+        high, low = self._times(pos)
+        return ((high & 0x3) << 32) | low
 
-    def __ge__(self, other):
-        return self.sortid >= int(other)
+    def generation(self, pos):
+        # type: (int) -> int
+        return self._times(pos)[0] >> 2
 
-    def __hash__(self):
-        return hash(self.id)
+# -- Pack bitmaps
 
-    def __hex__(self):
-        return hex(self.id)
+# see Documentation/technical/bitmap-format.txt in git
+_BITMAP_OPT_FULL_DAG = 0x1
 
-    def __int__(self):
-        # the real impetus for this method is to pass %d string operators
-        # without failure, so while line below is more accurate, it's too
-        # verbose
-        # return int(self.hex, base=16)
-        return self.sortid
+def _ewahbits(data, offset):
+    # type: (bytes, int) -> Tuple[int, int]
+    """
+    Decode the EWAH compressed bitmap at `offset`.
 
-def oid(rev):
-    return getattr(rev, 'id', rev)
+    Return the bitmap as the bits of an integer, and the offset following it.
+    """
+    bitsize, nwords = struct.unpack_from('>II', data, offset)
+    offset += 8
+    end = offset + 8 * nwords
+    # 64-bit words as hex digits, lowest word first
+    words = []
+    while offset < end:
+        rlw, = struct.unpack_from('>Q', data, offset)
+        offset += 8
+        runlength = (rlw >> 1) & 0xffffffff
+        if runlength:
+            words.append(('f' if rlw & 1 else '0') * 16 * runlength)
+        literals = binascii.hexlify(data[offset:offset + 8 * (rlw >> 33)])
+        words.extend(literals[i:i + 16] for i in xrange(0, len(literals), 16))
+        offset += len(literals) // 2
+    words.reverse()
+    bits = int(''.join(words) or '0', 16) & ((1 << bitsize) - 1)
+    # skip the position of the last run-length word
+    return bits, end + 4
+
+class gitpackbitmap(object):
+    """
+    The reachability bitmaps of a pack, as written by `git repack -b`.
 
-def branches_with(repo, commit):
-    result = []
-    for branch_name in repo.branches:
-        branch = repo.branches[branch_name]
-        target = branch.peel().id
-        if target == commit.id or repo.descendant_of(target, commit.id):
-            result.append(target)
-    return result
+    A bitmap is stored for a selection of commits, with a bit set for each
+    object of the pack reachable from the commit, by position in the pack.
+    The revisions of the commits of the pack are stored in
+    .git/gilded/packbitmap-<pack checksum>-<index generation>-v2 in the order
+    of the pack, so that translating a bitmap to revisions does not involve
+    the object database.
+
+    Bitmaps follow every parent of an octopus merge, where the parent table
+    only has the first two, so they can't be used when the pack holds one.
+    """
+    def __init__(self, index, packpath):
+        # type: (gitrevindex, str) -> None
+        self._index = index
+        self._repo = index._repo
+        with open(packpath + '.bitmap', 'rb') as f:
+            self.data = data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, count, checksum = struct.unpack_from(
+            '>4sHHI20s', data, 0)
+        if (magic != b'BITM' or version != 1 or
+                not flags & _BITMAP_OPT_FULL_DAG):
+            raise ValueError('unsupported bitmap: %s' % packpath)
+        self.checksum = checksum
+        # the commits type bitmap comes first, trees, blobs and tags follow
+        self.commits, offset = _ewahbits(data, 32)
+        for i in xrange(3):
+            offset = _ewahbits(data, offset)[1]
+        self._packpath = packpath
+        self._idx = None
+        # idx position, xor offset and bitmap offset of each selected commit
+        self._entries = []
+        for i in xrange(count):
+            position, xoroffset, entryflags = struct.unpack_from(
+                '>IBB', data, offset)
+            self._entries.append((position, xoroffset, offset + 6))
+            bitsize, nwords = struct.unpack_from('>II', data, offset + 6)
+            offset += 6 + 8 + 8 * nwords + 4
+        self._entrybits = {}
+
+    @classmethod
+    def load(cls, index):
+        # type: (gitrevindex) -> Optional[gitpackbitmap]
+        """Return the bitmap of the packs of a repository, or None"""
+        packdir = os.path.join(index._gitrepo.path, 'objects', 'pack')
+        try:
+            names = os.listdir(packdir)
+        except OSError:
+            return None
+        for name in sorted(names):
+            # at most one pack has a bitmap
+            if name.startswith('pack-') and name.endswith('.bitmap'):
+                packpath = os.path.join(packdir, name[:-len('.bitmap')])
+                try:
+                    return cls(index, packpath)
+                except (IOError, OSError, ValueError, struct.error):
+                    return None
+        return None
+
+    def _idxdata(self):
+        # type: () -> Tuple[bytes, int]
+        if self._idx is None:
+            with open(self._packpath + '.idx', 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:8] != b'\377tOc\0\0\0\2':
+                raise ValueError('unsupported pack index: %s' % self._packpath)
+            count = struct.unpack_from('>I', data, 8 + 255 * 4)[0]
+            self._idx = (data, count)
+        return self._idx
+
+    def _idxnode(self, position):
+        # type: (int) -> bytes
+        data, count = self._idxdata()
+        offset = 8 + 256 * 4 + 20 * position
+        return data[offset:offset + 20]
+
+    def _packorder(self):
+        # type: () -> array.array
+        """Return the idx positions of the objects in pack order"""
+        try:
+            with open(self._packpath + '.rev', 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = None
+        if data is not None and data[:8] == b'RIDX\0\0\0\1':
+            order = array.array('I')
+            order.fromstring(data[12:len(data) - 40])
+            if sys.byteorder != 'big':
+                order.byteswap()
+            return order
+        # no reverse index: sort the objects by offset
+        idx, count = self._idxdata()
+        offsets = array.array('I')
+        start = 8 + 256 * 4 + 24 * count
+        offsets.fromstring(idx[start:start + 4 * count])
+        if sys.byteorder != 'big':
+            offsets.byteswap()
+        large = start + 4 * count
+        def offset(i):
+            value = offsets[i]
+            if value & 0x80000000:
+                value = struct.unpack_from(
+                    '>Q', idx, large + 8 * (value & 0x7fffffff))[0]
+            return value
+        return array.array('I', sorted(xrange(count), key=offset))
+
+    @propertycache
+    def _filename(self):
+        return 'packbitmap-%s-%s-v2' % (binascii.hexlify(self.checksum),
+                                        self._index.generation)
+
+    @propertycache
+    def _table(self):
+        # type: () -> array.array
+        """Whether the pack holds an octopus merge, then the revisions of
+        the commits of the pack, in pack order. Commits that are not indexed
+        are -1."""
+        index = self._index
+        vfs = self._repo.cachevfs
+        ncommits = bin(self.commits).count('1')
+        revs = array.array('i')
+        try:
+            data = vfs.read(self._filename)
+        except (IOError, OSError):
+            data = b''
+        # the length of the index when the file was written comes first
+        revs.fromstring(data)
+        if sys.byteorder != 'big':
+            revs.byteswap()
+        # past the stored revisions, the index may number commits differently
+        if (len(revs) == ncommits + 2 and max(revs) <= index.ondisk and
+                (revs[0] == len(index) or -1 not in revs)):
+            return revs[1:]
+
+        order = self._packorder()
+        octopus = 0
+        revs = array.array('i', [len(index), octopus])
+        for position in _bitpositions(self.commits):
+            raw = self._idxnode(order[position])
+            rev = index.rev(pygit2.Oid(raw=raw))
+            revs.append(-1 if rev is None else rev)
+            if not octopus and len(index._parentsof(raw)) > 2:
+                octopus = revs[1] = 1
+        if index.ondisk < len(index):
+            # some of the revisions are only numbered in memory
+            return revs[1:]
+        data = array.array('i', revs)
+        if sys.byteorder != 'big':
+            data.byteswap()
+        try:
+            with self._repo._cachelock():
+                with vfs(self._filename, 'wb', atomictemp=True) as f:
+                    f.write(data.tostring())
+                # drop the revisions of packs that have been repacked since,
+                # and of other generations of the index
+                for name in vfs.listdir():
+                    if name.startswith('packbitmap-') and \
+                            name != self._filename:
+                        vfs.tryunlink(name)
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write pack bitmap revisions: %s\n"
+                                % stringutil.forcebytestr(inst))
+        return revs[1:]
+
+    @property
+    def octopus(self):
+        # type: () -> bool
+        """Whether a commit of the pack has more than two parents"""
+        return bool(self._table[0])
+
+    @propertycache
+    def _posrev(self):
+        # type: () -> Dict[int, int]
+        """Revision of each commit of the pack, by pack position"""
+        return dict(itertools.izip(_bitpositions(self.commits),
+                                   itertools.islice(self._table, 1, None)))
+
+    @propertycache
+    def _revpos(self):
+        # type: () -> Dict[int, int]
+        """Pack position of each indexed commit of the pack, by revision"""
+        return dict((rev, position)
+                    for position, rev in self._posrev.iteritems() if rev >= 0)
+
+    @propertycache
+    def _selected(self):
+        # type: () -> Dict[int, int]
+        """Entry of each commit with a bitmap, by revision"""
+        index = self._index
+        selected = {}
+        for i, (position, xoroffset, offset) in enumerate(self._entries):
+            rev = index.rev(pygit2.Oid(raw=self._idxnode(position)))
+            if rev is not None:
+                selected[rev] = i
+        return selected
+
+    def _bitmap(self, i):
+        # type: (int) -> int
+        """Return the bitmap of an entry, in pack positions"""
+        bits = self._entrybits.get(i)
+        if bits is None:
+            position, xoroffset, offset = self._entries[i]
+            bits = _ewahbits(self.data, offset)[0]
+            if xoroffset:
+                bits ^= self._bitmap(i - xoroffset)
+            self._entrybits[i] = bits
+        return bits
+
+    def ancestors(self, heads):
+        # type: (Iterable[int]) -> int
+        """
+        Return the ancestors of heads, inclusive, as the bits of an integer.
+
+        The commits between the heads and the closest commits with a bitmap
+        are walked.
+        """
+        index = self._index
+        p1, p2 = index.p1, index.p2
+        selected = self._selected
+        positions = self._revpos
+        packbits = 0
+        walked = set()
+        stack = [rev for rev in heads if rev >= 0]
+        while stack:
+            rev = stack.pop()
+            if rev in walked:
+                continue
+            i = selected.get(rev)
+            if i is not None:
+                packbits |= self._bitmap(i)
+                continue
+            position = positions.get(rev)
+            if position is not None and packbits >> position & 1:
+                # already covered by a bitmap
+                continue
+            walked.add(rev)
+            for parent in (p1[rev], p2[rev]):
+                if parent >= 0:
+                    stack.append(parent)
+
+        posrev = self._posrev
+        data = bytearray((len(index) >> 3) + 1)
+        for rev in itertools.chain(
+                walked, (posrev[position] for position
+                         in _bitpositions(packbits & self.commits))):
+            if rev >= 0:
+                data[rev >> 3] |= 1 << (rev & 7)
+        return _bytestobits(data)
+
+# -- Revision index
+
+class gitrevindex(object):
+    """
+    Persistent mapping between git commits and mercurial revision numbers.
+
+    Every indexed commit is assigned a permanent integer revision, in
+    topological order, so that parents always have a lower revision than
+    their children. The index is stored in .git/gilded/ as a flat array of
+    20 byte nodes. Commits are only ever appended to it, so a commit keeps
+    its revision from one command to the next, even after it becomes
+    unreachable. The changelog filters out the unreachable ones.
+
+    The index also holds the parent table: `p1` and `p2` are parallel arrays
+    of parent revisions, indexed by revision, with nullrev for a missing
+    parent. They are stored next to the nodes as pairs of big-endian int32.
+    Like mercurial, only the first two parents of an octopus merge are
+    recorded.
+
+    The index is shared by concurrent commands: it is only added to while
+    holding the cache lock, after picking up what other commands appended
+    since it was loaded. Rewriting the file, instead of appending to it,
+    changes the `generation` of the index. Within a generation, only the
+    first `ondisk` revisions are numbered the same way by every command.
+    """
+    _filename = 'revs-v2'
+    _parentsfilename = 'parents-%s-v1'
+    # magic, generation
+    _header = struct.Struct('>4s8s')
+    _magic = b'GREV'
+
+    def __init__(self, repo):
+        # type: (gitrepository) -> None
+        self._repo = repo
+        self._gitrepo = repo._repo
+        self._nodes = bytearray()
+        self._nodemap = {}
+        self.p1 = array.array('i')
+        self.p2 = array.array('i')
+        self.generation = self._newgeneration()
+        # number of revisions that are known to be on disk, for this
+        # generation. revisions past it are only numbered in memory.
+        self.ondisk = 0
+        # same, for the parent table
+        self._parentsondisk = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._nodemap)
+
+    @staticmethod
+    def _newgeneration():
+        # type: () -> str
+        return binascii.hexlify(os.urandom(8))
+
+    def _read(self, filename):
+        try:
+            return self._repo.cachevfs.read(filename)
+        except (IOError, OSError):
+            return b''
+
+    def _readparents(self, start, stop):
+        # type: (int, int) -> Tuple[array.array, array.array]
+        """Read the stored parents of revisions start to stop, or as many of
+        them as there are"""
+        pdata = self._read(self._parentsfilename % self.generation)
+        pdata = pdata[start * 8:stop * 8]
+        pairs = array.array('i')
+        pairs.fromstring(pdata[:len(pdata) - len(pdata) % 8])
+        if sys.byteorder != 'big':
+            pairs.byteswap()
+        return pairs[0::2], pairs[1::2]
+
+    def _load(self):
+        data = self._read(self._filename)
+        header = self._header
+        if len(data) < header.size:
+            return
+        magic, generation = header.unpack_from(data)
+        if magic != self._magic:
+            return
+        data = data[header.size:]
+        nodemap = self._nodemap
+        count = len(data) // 20
+        for rev in xrange(count):
+            raw = data[rev * 20:(rev + 1) * 20]
+            if raw in nodemap:
+                # the file is corrupt. start over.
+                self._repo.ui.debug('discarding corrupt revision index\n')
+                nodemap.clear()
+                return
+            nodemap[raw] = rev
+        self._nodes[:] = data[:count * 20]
+        self.generation = binascii.hexlify(generation)
+        if count * 20 == len(data):
+            self.ondisk = count
+
+        self.p1, self.p2 = self._readparents(0, count)
+        known = self._parentsondisk = len(self.p1)
+        if known < count:
+            # the parent table is older than the index: catch up
+            self._fillparents(known)
+
+    def _sync(self):
+        # type: () -> bool
+        """Pick up the revisions other commands appended to the index file
+        since it was loaded.
+
+        Return False if the file was rewritten, or if it can't be appended to
+        because this index numbered commits of its own in the meantime."""
+        data = self._read(self._filename)
+        header = self._header
+        start = header.size + self.ondisk * 20
+        if (data[:header.size] != header.pack(
+                self._magic, binascii.unhexlify(self.generation)) or
+                len(data) < start or (len(data) - header.size) % 20):
+            return False
+        if len(self) > self.ondisk:
+            return len(data) == start
+        nodemap = self._nodemap
+        nodes = self._nodes
+        first = len(self)
+        for offset in xrange(start, len(data), 20):
+            raw = data[offset:offset + 20]
+            if raw in nodemap:
+                return False
+            nodemap[raw] = len(nodes) // 20
+            nodes.extend(raw)
+        if self._parentsondisk == first:
+            p1, p2 = self._readparents(first, len(self))
+            self.p1.extend(p1)
+            self.p2.extend(p2)
+            self._parentsondisk += len(p1)
+        self._fillparents(len(self.p1))
+        self.ondisk = len(self)
+        return True
+
+    @propertycache
+    def graph(self):
+        # type: () -> Optional[gitcommitgraph]
+        return gitcommitgraph.load(self._gitrepo.path)
+
+    @propertycache
+    def bitmap(self):
+        # type: () -> Optional[gitpackbitmap]
+        bitmap = gitpackbitmap.load(self)
+        if bitmap is not None and bitmap.octopus:
+            # the bitmaps would bring in the ancestors of the parents the
+            # parent table leaves out
+            return None
+        return bitmap
+
+    def _parentsof(self, raw):
+        # type: (bytes) -> List[bytes]
+        """Return the parents of a commit as raw nodes.
+
+        The commit-graph is used when it covers the commit, so that the
+        commit object doesn't need to be inflated."""
+        graph = self.graph
+        if graph is not None:
+            parents = graph.parentnodes(raw)
+            if parents is not None:
+                return parents
+        commit = self._gitrepo[pygit2.Oid(raw=raw)]
+        return [p.raw for p in commit.parent_ids]
+
+    def _fillparents(self, start):
+        for rev in xrange(start, len(self)):
+            self._addparents(self._parentsof(bytes(self._nodes[rev * 20:
+                                                               (rev + 1) * 20])))
+
+    def _addparents(self, parents):
+        # type: (List[bytes]) -> None
+        nodemap = self._nodemap
+        # parents can be missing in a shallow clone
+        revs = [nodemap[p] for p in parents if p in nodemap]
+        revs.extend((nullrev, nullrev))
+        self.p1.append(revs[0])
+        self.p2.append(revs[1])
+
+    def node(self, rev):
+        # type: (int) -> pygit2.Oid
+        if rev < 0:
+            raise IndexError(rev)
+        raw = self._nodes[rev * 20:(rev + 1) * 20]
+        if not raw:
+            raise IndexError(rev)
+        return pygit2.Oid(raw=bytes(raw))
+
+    def rev(self, oid):
+        # type: (pygit2.Oid) -> Optional[int]
+        """Return the revision of an indexed commit, or None"""
+        return self._nodemap.get(oid.raw)
+
+    def update(self, tips=None):
+        # type: (Optional[List[pygit2.Oid]]) -> None
+        """
+        Index the given commits and all of their ancestors.
+
+        If no commits are given, index everything reachable from refs.
+        """
+        if tips is None:
+            tips = reftips(self._repo)
+        nodemap = self._nodemap
+        if all(t.raw in nodemap for t in tips):
+            return
+        try:
+            lock = self._repo._cachelock()
+        except error.LockError as inst:
+            # number them in memory only
+            self._repo.ui.debug("couldn't lock revision index: %s\n"
+                                % stringutil.forcebytestr(inst))
+            lock = None
+        try:
+            append = lock is not None and self._sync()
+            missing = [t.raw for t in tips if t.raw not in nodemap]
+            if missing:
+                self._add(missing)
+            if lock is not None and (missing or not append):
+                self._write(append)
+        finally:
+            lockmod.release(lock)
+
+    def _add(self, missing):
+        # type: (List[bytes]) -> None
+        # depth-first walk from the new tips down to the indexed commits,
+        # numbering each commit after its parents. every ancestor of an
+        # indexed commit is indexed too, so the walk never goes below them.
+        nodemap = self._nodemap
+        nodes = self._nodes
+        parentsof = self._parentsof
+        # raw -> parents, or None if the object is missing (shallow clone)
+        pending = {}
+        for tip in missing:
+            stack = [tip]
+            while stack:
+                cur = stack[-1]
+                if cur in nodemap:
+                    stack.pop()
+                    continue
+                if cur not in pending:
+                    try:
+                        pending[cur] = parentsof(cur)
+                    except KeyError:
+                        pending[cur] = None
+                parents = pending[cur]
+                if parents is None:
+                    stack.pop()
+                    continue
+                todo = [p for p in parents
+                        if p not in nodemap and pending.get(p, ()) is not None]
+                if todo:
+                    # visit the first parent first, so that it gets the
+                    # lower revisions
+                    todo.reverse()
+                    stack.extend(todo)
+                else:
+                    stack.pop()
+                    self._addparents(parents)
+                    nodemap[cur] = len(nodes) // 20
+                    nodes.extend(cur)
+
+    def _parentdata(self, start):
+        # type: (int) -> bytes
+        pairs = array.array('i', [nullrev, nullrev]) * (len(self) - start)
+        pairs[0::2] = self.p1[start:]
+        pairs[1::2] = self.p2[start:]
+        if sys.byteorder != 'big':
+            pairs.byteswap()
+        return pairs.tostring()
+
+    def _write(self, append):
+        # type: (bool) -> None
+        """Write the index, with the cache lock held. If `append` is False,
+        the file is rewritten as a new generation."""
+        vfs = self._repo.cachevfs
+        try:
+            if append:
+                with vfs(self._filename, 'ab') as f:
+                    f.write(bytes(self._nodes[self.ondisk * 20:]))
+                parentsfile = self._parentsfilename % self.generation
+                start = self._parentsondisk
+                if not vfs.exists(parentsfile) or \
+                        vfs.stat(parentsfile).st_size != start * 8:
+                    start = 0
+                with vfs(parentsfile, 'ab' if start else 'wb',
+                         atomictemp=not start) as f:
+                    f.write(self._parentdata(start))
+            else:
+                generation = self._newgeneration()
+                # the parent table first: it is not used before the index
+                # file refers to its generation
+                parentsfile = self._parentsfilename % generation
+                with vfs(parentsfile, 'wb', atomictemp=True) as f:
+                    f.write(self._parentdata(0))
+                with vfs(self._filename, 'wb', atomictemp=True) as f:
+                    f.write(self._header.pack(self._magic,
+                                              binascii.unhexlify(generation)))
+                    f.write(bytes(self._nodes))
+                self.generation = generation
+                # drop the parent tables of the other generations
+                for name in vfs.listdir():
+                    if name.startswith('parents-') and name != parentsfile:
+                        vfs.tryunlink(name)
+                vfs.tryunlink('revs-v1')
+            self.ondisk = self._parentsondisk = len(self)
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write revision index: %s\n"
+                                % stringutil.forcebytestr(inst))
+
+def unlinkgenerations(vfs, prefix, generation):
+    # type: (vfsmod.vfs, str, str) -> None
+    """Remove the files of a cache keyed by revision which belong to other
+    generations of the revision index"""
+    for name in vfs.listdir():
+        if name.startswith(prefix) and '-%s-' % generation not in name:
+            vfs.tryunlink(name)
+
+def walkrevs(index, heads, hidden=(), stoprev=0):
+    # type: (gitrevindex, Iterable[int], Iterable[int], int) -> Iterator[int]
+    """
+    Yield the revisions reachable from heads but not from hidden, in
+    descending order, using the parent table of the index.
+
+    Revisions are numbered topologically, so popping the highest queued
+    revision guarantees that all of its children have been seen. The walk
+    stops as soon as only hidden revisions remain queued. Revisions below
+    `stoprev` are neither yielded nor walked.
+    """
+    p1, p2 = index.p1, index.p2
+    heappush, heappop = heapq.heappush, heapq.heappop
+    # rev -> whether it is hidden
+    state = {}
+    heap = []
+    interesting = 0
+    stoprev = max(stoprev, 0)
+    for rev in hidden:
+        if rev >= stoprev and rev not in state:
+            state[rev] = True
+            heappush(heap, -rev)
+    for rev in heads:
+        if rev >= stoprev and rev not in state:
+            state[rev] = False
+            heappush(heap, -rev)
+            interesting += 1
+    while interesting:
+        rev = -heappop(heap)
+        ishidden = state[rev]
+        if not ishidden:
+            interesting -= 1
+            yield rev
+        for parent in (p1[rev], p2[rev]):
+            if parent < stoprev:
+                continue
+            seen = state.get(parent)
+            if seen is None:
+                state[parent] = ishidden
+                heappush(heap, -parent)
+                if not ishidden:
+                    interesting += 1
+            elif ishidden and not seen:
+                state[parent] = True
+                interesting -= 1
+
+def ancestorbits(index, heads, hidden=(), stoprev=0):
+    # type: (gitrevindex, Iterable[int], Iterable[int], int) -> int
+    """
+    Return the revisions reachable from heads but not from hidden as the
+    bits of an integer, leaving out revisions below `stoprev`.
+
+    The pack bitmap answers the question when there is one, otherwise the
+    parent table is walked.
+    """
+    heads = [r for r in heads if r >= 0]
+    hidden = [r for r in hidden if r >= 0]
+    bitmap = index.bitmap
+    if bitmap is not None:
+        bits = bitmap.ancestors(heads)
+        if hidden:
+            bits &= ~bitmap.ancestors(hidden)
+        return bits & ~((1 << max(stoprev, 0)) - 1)
+    return _revbits(walkrevs(index, heads, hidden, stoprev))
+
+# -- Children index
+
+class gitchildindex(object):
+    """
+    The reverse edges of the parent table of a revision index.
+
+    The children of a revision form a linked list, newest first:
+    `lastchild` holds the newest child of each revision, and `sibling1` and
+    `sibling2` lead from a child to the next older child of its first and
+    second parent. A new revision can only become the newest child of its
+    parents, so the index grows by appending the sibling pointers of the new
+    revisions and patching the last child of their parents in place. Both
+    are stored in .git/gilded/, under the generation of the revision index.
+
+    `children()` and `descendants()` leave out the revisions in `filtered`,
+    which the changelog sets to the commits that are no longer reachable.
+    """
+    def __init__(self, index):
+        # type: (gitrevindex) -> None
+        self._index = index
+        self._repo = index._repo
+        self._generation = index.generation
+        self.lastchild = array.array('i')
+        self.sibling1 = array.array('i')
+        self.sibling2 = array.array('i')
+        self.filtered = frozenset()  # type: Container[int]
+        # number of entries that are known to be on disk
+        self._ondisk = 0
+        # revisions from before _ondisk whose newest child changed since
+        self._patched = set()
+        self._load()
+
+    def __len__(self):
+        return len(self.lastchild)
+
+    @property
+    def _lastfilename(self):
+        # type: () -> str
+        return 'children-last-%s-v1' % self._generation
+
+    @property
+    def _siblingsfilename(self):
+        # type: () -> str
+        return 'children-siblings-%s-v1' % self._generation
+
+    def _read(self, filename):
+        # type: (str) -> array.array
+        try:
+            data = self._repo.cachevfs.read(filename)
+        except (IOError, OSError):
+            data = b''
+        values = array.array('i')
+        values.fromstring(data[:len(data) - len(data) % 4])
+        if sys.byteorder != 'big':
+            values.byteswap()
+        return values
+
+    def _load(self):
+        last = self._read(self._lastfilename)
+        siblings = self._read(self._siblingsfilename)
+        count = len(last)
+        if (len(siblings) != 2 * count or count > self._index.ondisk or
+                (count and max(last) >= count)):
+            # interrupted while writing, or past the revisions the index has
+            # stored. start over.
+            return
+        self.lastchild = last
+        self.sibling1 = siblings[0::2]
+        self.sibling2 = siblings[1::2]
+        self._ondisk = count
+
+    def update(self):
+        """Add the revisions appended to the revision index"""
+        index = self._index
+        start = len(self)
+        stop = len(index)
+        if start >= stop:
+            return
+        p1, p2 = index.p1, index.p2
+        last = self.lastchild
+        ondisk = self._ondisk
+        patched = self._patched
+        for rev in xrange(start, stop):
+            last.append(nullrev)
+            parent1, parent2 = p1[rev], p2[rev]
+            if parent2 == parent1:
+                parent2 = nullrev
+            for parent, siblings in ((parent1, self.sibling1),
+                                     (parent2, self.sibling2)):
+                if parent == nullrev:
+                    siblings.append(nullrev)
+                    continue
+                siblings.append(last[parent])
+                last[parent] = rev
+                if parent < ondisk:
+                    patched.add(parent)
+        self._write()
+
+    @staticmethod
+    def _data(values):
+        # type: (array.array) -> bytes
+        if sys.byteorder != 'big':
+            values = array.array('i', values)
+            values.byteswap()
+        return values.tostring()
+
+    def _write(self):
+        index = self._index
+        if index.ondisk < len(self):
+            # some of the revisions are only numbered in memory
+            return
+        if index.generation != self._generation:
+            # the index was rewritten since the children were loaded
+            self._generation = index.generation
+            self._ondisk = 0
+        vfs = self._repo.cachevfs
+        ondisk = self._ondisk
+        try:
+            with self._repo._cachelock():
+                for filename, width in ((self._lastfilename, 4),
+                                        (self._siblingsfilename, 8)):
+                    if not vfs.exists(filename) or \
+                            vfs.stat(filename).st_size != ondisk * width:
+                        # out of sync with what we loaded, rewrite everything
+                        ondisk = 0
+                siblings = array.array('i', [nullrev, nullrev]) * (
+                    len(self) - ondisk)
+                siblings[0::2] = self.sibling1[ondisk:]
+                siblings[1::2] = self.sibling2[ondisk:]
+                if ondisk:
+                    # the patched entries point past the end of the siblings
+                    # until they are appended, which _load detects
+                    with vfs(self._lastfilename, 'r+b') as f:
+                        for parent in sorted(self._patched):
+                            f.seek(parent * 4)
+                            f.write(struct.pack('>i', self.lastchild[parent]))
+                        f.seek(ondisk * 4)
+                        f.write(self._data(self.lastchild[ondisk:]))
+                    with vfs(self._siblingsfilename, 'ab') as f:
+                        f.write(self._data(siblings))
+                else:
+                    with vfs(self._lastfilename, 'wb', atomictemp=True) as f:
+                        f.write(self._data(self.lastchild))
+                    with vfs(self._siblingsfilename, 'wb',
+                             atomictemp=True) as f:
+                        f.write(self._data(siblings))
+                    unlinkgenerations(vfs, 'children-', self._generation)
+            self._ondisk = len(self)
+            self._patched.clear()
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write children index: %s\n"
+                                % stringutil.forcebytestr(inst))
+
+    def heads(self):
+        # type: () -> List[int]
+        """Return the revisions without children, in ascending order,
+        including the filtered ones"""
+        # nullrev is all ones in either byte order, let find() do the scan
+        data = self.lastchild.tostring()
+        marker = b'\xff' * 4
+        heads = []
+        pos = data.find(marker)
+        while pos != -1:
+            if pos % 4:
+                pos = data.find(marker, pos + 1)
+                continue
+            heads.append(pos // 4)
+            pos = data.find(marker, pos + 4)
+        return heads
+
+    def children(self, rev):
+        # type: (int) -> List[int]
+        """Return the children of a revision, in ascending order"""
+        index = self._index
+        p1 = index.p1
+        filtered = self.filtered
+        if rev == nullrev:
+            return [r for r in xrange(len(index))
+                    if p1[r] == nullrev and index.p2[r] == nullrev and
+                    r not in filtered]
+        sibling1, sibling2 = self.sibling1, self.sibling2
+        children = []
+        child = self.lastchild[rev]
+        while child != nullrev:
+            if child not in filtered:
+                children.append(child)
+            child = sibling1[child] if p1[child] == rev else sibling2[child]
+        children.reverse()
+        return children
+
+    def descendants(self, revs, within=None):
+        # type: (Iterable[int], Optional[Container[int]]) -> int
+        """
+        Return the descendants of revs, inclusive, as the bits of an integer.
+
+        If `within` is given, the walk does not leave it.
+        """
+        lastchild, sibling1, sibling2 = (self.lastchild, self.sibling1,
+                                         self.sibling2)
+        p1 = self._index.p1
+        filtered = self.filtered
+        data = bytearray((len(self) >> 3) + 1)
+        stack = []
+        for rev in revs:
+            if rev == nullrev:
+                # everything descends from null, through the roots
+                stack.extend(self.children(nullrev))
+            else:
+                stack.append(rev)
+        while stack:
+            rev = stack.pop()
+            i, bit = rev >> 3, 1 << (rev & 7)
+            if (data[i] & bit or rev in filtered or
+                    within is not None and rev not in within):
+                continue
+            data[i] |= bit
+            child = lastchild[rev]
+            while child != nullrev:
+                stack.append(child)
+                child = sibling1[child] if p1[child] == rev \
+                    else sibling2[child]
+        return _bytestobits(data)
+
+# -- Commit metadata
+
+class gitmetadatastore(object):
+    """
+    Columnar store of commit metadata, indexed by revision.
+
+    Authors are interned: `authors` holds an id per revision into `names`.
+    `times` and `tzoffsets` hold the commit date, and `descends` the end
+    offset of each commit message within the concatenated messages. The
+    columns are stored in .git/gilded/ and new revisions are appended as the
+    revision index grows, so the predicates that filter on metadata never
+    need to inflate commit objects. The file names include the generation of
+    the revision index.
+    """
+    # column name, array typecode. times and offsets are stored as doubles,
+    # which are exact for any realistic value and have the same size on
+    # every platform.
+    _columns = [
+        ('authors', 'i'),
+        ('times', 'd'),
+        ('tzoffsets', 'i'),
+        ('descends', 'd'),
+    ]
+
+    def __init__(self, changelog):
+        # type: (gitchangelog) -> None
+        self._changelog = changelog
+        self._index = changelog.index
+        self._repo = changelog._repo
+        self._gitrepo = changelog._gitrepo
+        self._generation = self._index.generation
+        self.names = []
+        self._nameids = {}
+        self.descs = bytearray()
+        for column, typecode in self._columns:
+            setattr(self, column, array.array(typecode))
+        # number of revisions that are known to be on disk
+        self._ondisk = 0
+        self._load()
+
+    def __len__(self):
+        return len(self.authors)
+
+    def _filename(self, name):
+        # type: (str) -> str
+        return 'meta-%s-%s-v1' % (name, self._generation)
+
+    def _read(self, filename):
+        try:
+            return self._repo.cachevfs.read(filename)
+        except (IOError, OSError):
+            return b''
+
+    def _load(self):
+        columns = []
+        for column, typecode in self._columns:
+            data = self._read(self._filename(column))
+            values = array.array(typecode)
+            values.fromstring(data[:len(data) - len(data) % values.itemsize])
+            if sys.byteorder != 'big':
+                values.byteswap()
+            columns.append(values)
+        names = self._read(self._filename('names'))
+        names = names.split(b'\n')[:-1] if names else []
+        descs = self._read(self._filename('descs'))
+
+        count = min(len(values) for values in columns)
+        # past the stored revisions, the index may number commits differently
+        count = min(count, self._index.ondisk)
+        authors, times, tzoffsets, descends = columns
+        if count and (descends[count - 1] > len(descs) or
+                      max(authors[:count]) >= len(names)):
+            # out of sync with the other files. start over.
+            count = 0
+        for (column, typecode), values in zip(self._columns, columns):
+            setattr(self, column, values[:count])
+        self.names = names
+        self._nameids = dict((n, i) for i, n in enumerate(names))
+        self.descs[:] = descs[:int(descends[count - 1]) if count else 0]
+        if count == len(columns[0]) and all(len(v) == count for v in columns) \
+                and len(self.descs) == len(descs):
+            self._ondisk = count
+
+    def update(self):
+        """Append the metadata of revisions added to the index"""
+        start = len(self)
+        cl = self._changelog
+        stop = len(cl)
+        if start >= stop:
+            return
+        gitrepo = self._gitrepo
+        nameids = self._nameids
+        names = self.names
+        descs = self.descs
+        for rev in xrange(start, stop):
+            try:
+                commit = gitrepo[cl.node(rev)]
+            except KeyError:
+                # pruned by git after it became unreachable. the revision is
+                # filtered, so leave its metadata empty.
+                name, time, tzoffset, message = b'', 0, 0, u''
+            else:
+                author = commit.author
+                name = (u"%s <%s>" % (author.name, author.email)).encode(
+                    'utf-8')
+                time = commit.commit_time
+                tzoffset = commit.commit_time_offset
+                message = commit.message
+            nameid = nameids.get(name)
+            if nameid is None:
+                nameid = nameids[name] = len(names)
+                names.append(name)
+            self.authors.append(nameid)
+            self.times.append(time)
+            self.tzoffsets.append(tzoffset)
+            descs.extend(message.encode('utf-8'))
+            self.descends.append(len(descs))
+        self._write()
+
+    def _data(self, column, start):
+        # type: (str, int) -> bytes
+        values = getattr(self, column)[start:]
+        if sys.byteorder != 'big':
+            values.byteswap()
+        return values.tostring()
+
+    def _write(self):
+        index = self._index
+        if index.ondisk < len(self):
+            # some of the revisions are only numbered in memory
+            return
+        if index.generation != self._generation:
+            # the index was rewritten since the columns were loaded
+            self._generation = index.generation
+            self._ondisk = 0
+        vfs = self._repo.cachevfs
+        ondisk = self._ondisk
+        descstart = int(self.descends[ondisk - 1]) if ondisk else 0
+        sizes = [(self._filename(column), ondisk * getattr(self, column).itemsize)
+                 for column, typecode in self._columns]
+        sizes.append((self._filename('descs'), descstart))
+        try:
+            with self._repo._cachelock():
+                for filename, size in sizes:
+                    if not vfs.exists(filename) or \
+                            vfs.stat(filename).st_size != size:
+                        # out of sync with what we loaded, rewrite everything
+                        ondisk = descstart = 0
+                mode = 'ab' if ondisk else 'wb'
+                for column, typecode in self._columns:
+                    with vfs(self._filename(column), mode,
+                             atomictemp=not ondisk) as f:
+                        f.write(self._data(column, ondisk))
+                with vfs(self._filename('descs'), mode,
+                         atomictemp=not ondisk) as f:
+                    f.write(bytes(self.descs[descstart:]))
+                # interned names are few, always rewrite them
+                with vfs(self._filename('names'), 'wb', atomictemp=True) as f:
+                    f.write(b''.join(n + b'\n' for n in self.names))
+                if not ondisk:
+                    unlinkgenerations(vfs, 'meta-', self._generation)
+            self._ondisk = len(self)
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write commit metadata: %s\n"
+                                % stringutil.forcebytestr(inst))
+
+    def authormask(self, matcher):
+        # type: (Callable[[bytes], bool]) -> bytearray
+        """Return a mask with the ids of the matching author names set"""
+        return bytearray(bool(matcher(n)) for n in self.names)
+
+    def description(self, rev):
+        # type: (int) -> bytes
+        descends = self.descends
+        start = int(descends[rev - 1]) if rev else 0
+        return bytes(self.descs[start:int(descends[rev])])
+
+    def descsearch(self, text):
+        # type: (bytes) -> Optional[int]
+        """
+        Return the revisions whose message contains text, ignoring case, as
+        the bits of an integer.
+
+        The messages are folded and searched all at once, which only works
+        if folding keeps their lengths: None is returned otherwise.
+        """
+        if not text:
+            return (1 << len(self)) - 1
+        descs = bytes(self.descs)
+        folded = encoding.lower(descs)
+        if len(folded) != len(descs):
+            return None
+        text = encoding.lower(text)
+        descends = self.descends
+        data = bytearray((len(self) >> 3) + 1)
+        find = folded.find
+        start = find(text)
+        while start >= 0:
+            rev = bisect.bisect_right(descends, start)
+            end = int(descends[rev])
+            if start + len(text) <= end:
+                data[rev >> 3] |= 1 << (rev & 7)
+                # one match per message is enough
+                start = find(text, end)
+            else:
+                # runs into the next message
+                start = find(text, start + 1)
+        return _bytestobits(data)
+
+# -- Text index
+
+def _foldcase(text):
+    # type: (bytes) -> bytes
+    return text.decode('utf-8', 'replace').lower().encode('utf-8')
+
+def _trigrams(text):
+    # type: (bytes) -> Set[int]
+    """Return the trigrams of `text`, as integers"""
+    unique = set(text[i:i + 3] for i in xrange(len(text) - 2))
+    return set(struct.unpack('>I', b'\0' + t)[0] for t in unique)
+
+def _requiredliterals(pattern):
+    # type: (bytes) -> List[bytes]
+    """Return substrings which any match of a regular expression contains"""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, OverflowError):
+        return []
+    literals = []
+    run = []
+    # only the top level is a plain concatenation, anything else (branches,
+    # repeats, character classes) ends the current run of literals
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+        elif run:
+            literals.append(b''.join(run))
+            run = []
+    if run:
+        literals.append(b''.join(run))
+    return literals
+
+class gittextindex(object):
+    """
+    Trigram index of the case-folded authors and messages of commits.
+
+    The index file is a sequence of segments, each covering a range of
+    revisions and mapping trigrams to the sorted revisions whose text contains
+    them. New revisions are appended as a new segment, and the segments are
+    merged into one once there are too many. The index is only used to rule
+    out revisions: the candidates it returns still need to be matched exactly.
+    Like the commit metadata, the file name includes the generation of the
+    revision index.
+    """
+    # magic, start rev, stop rev, number of trigrams, number of postings
+    _header = struct.Struct('>4siiii')
+    _magic = b'GTXI'
+    # merge everything into a single segment past this many segments
+    _maxsegments = 16
+
+    def __init__(self, metadata):
+        # type: (gitmetadatastore) -> None
+        self._metadata = metadata
+        self._index = metadata._index
+        self._repo = metadata._repo
+        self._generation = self._index.generation
+        # (start rev, stop rev, trigrams, posting ends, postings offset)
+        self._segments = []
+        self._data = b''
+        # size of the valid part of the file
+        self._size = 0
+        self._load()
+
+    def __len__(self):
+        # revisions are covered from 0 up to this
+        return self._segments[-1][1] if self._segments else 0
+
+    @property
+    def _filename(self):
+        # type: () -> str
+        return 'textindex-%s-v1' % self._generation
+
+    @staticmethod
+    def _array(data, offset, count):
+        # type: (bytes, int, int) -> array.array
+        values = array.array('i')
+        values.fromstring(data[offset:offset + 4 * count])
+        if sys.byteorder != 'big':
+            values.byteswap()
+        return values
+
+    @staticmethod
+    def _tobytes(values):
+        # type: (array.array) -> bytes
+        if sys.byteorder != 'big':
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        return values.tostring()
+
+    def _load(self):
+        self._segments = []
+        self._data = b''
+        self._size = 0
+        try:
+            with self._repo.cachevfs(self._filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # missing or empty
+            return
+        header = self._header
+        # past the stored revisions, the index may number commits differently
+        ondisk = self._index.ondisk
+        offset = stop = 0
+        while offset + header.size <= len(data):
+            magic, start, end, ntrigrams, npostings = header.unpack_from(
+                data, offset)
+            tableoffset = offset + header.size
+            postingsoffset = tableoffset + 8 * ntrigrams
+            segmentend = postingsoffset + 4 * npostings
+            if (magic != self._magic or start != stop or end <= start or
+                    segmentend > len(data) or end > ondisk):
+                # truncated or garbage, ignore the rest of the file
+                break
+            trigrams = self._array(data, tableoffset, ntrigrams)
+            ends = self._array(data, tableoffset + 4 * ntrigrams, ntrigrams)
+            self._segments.append((start, end, trigrams, ends, postingsoffset))
+            offset = segmentend
+            stop = end
+        self._data = data
+        self._size = offset
+
+    def _segment(self, start, stop):
+        # type: (int, int) -> bytes
+        meta = self._metadata
+        names = meta.names
+        authors = meta.authors
+        nametrigrams = {}
+        postings = collections.defaultdict(lambda: array.array('i'))
+        for rev in xrange(start, stop):
+            nameid = authors[rev]
+            trigrams = nametrigrams.get(nameid)
+            if trigrams is None:
+                trigrams = nametrigrams[nameid] = _trigrams(
+                    _foldcase(names[nameid]))
+            trigrams = trigrams | _trigrams(_foldcase(meta.description(rev)))
+            for trigram in trigrams:
+                postings[trigram].append(rev)
+        keys = array.array('i', sorted(postings))
+        ends = array.array('i')
+        allpostings = array.array('i')
+        for key in keys:
+            allpostings.extend(postings[key])
+            ends.append(len(allpostings))
+        header = self._header.pack(self._magic, start, stop, len(keys),
+                                   len(allpostings))
+        return header + b''.join(self._tobytes(values)
+                                 for values in (keys, ends, allpostings))
+
+    def _write(self, start, stop):
+        # type: (int, int) -> None
+        if self._index.ondisk < stop:
+            # some of the revisions are only numbered in memory
+            return
+        vfs = self._repo.cachevfs
+        data = self._segment(start, stop) if stop else b''
+        try:
+            with self._repo._cachelock():
+                if start and not self._canappend():
+                    # another command wrote it since it was loaded
+                    start = 0
+                    data = self._segment(start, stop)
+                if start:
+                    with vfs(self._filename, 'ab') as f:
+                        f.write(data)
+                else:
+                    with vfs(self._filename, 'wb', atomictemp=True) as f:
+                        f.write(data)
+                    unlinkgenerations(vfs, 'textindex-', self._generation)
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write text index: %s\n"
+                                % stringutil.forcebytestr(inst))
+        self._load()
+
+    def _canappend(self):
+        vfs = self._repo.cachevfs
+        try:
+            return vfs.stat(self._filename).st_size == self._size
+        except (IOError, OSError):
+            return False
+
+    def update(self):
+        """Index the revisions added to the commit metadata"""
+        meta = self._metadata
+        meta.update()
+        start = len(self)
+        stop = len(meta)
+        generation = self._index.generation
+        if generation != self._generation:
+            # the index was rewritten since the text index was loaded
+            self._generation = generation
+            start = 0
+        elif start == stop:
+            return
+        if (start > stop or len(self._segments) >= self._maxsegments or
+                not self._canappend()):
+            start = 0
+        self._write(start, stop)
+
+    def rebuild(self):
+        """Index all the revisions from scratch"""
+        meta = self._metadata
+        meta.update()
+        self._generation = self._index.generation
+        self._write(0, len(meta))
+
+    def _postings(self, segment, trigram):
+        # type: (Tuple, int) -> array.array
+        start, stop, trigrams, ends, offset = segment
+        i = bisect.bisect_left(trigrams, trigram)
+        if i == len(trigrams) or trigrams[i] != trigram:
+            return array.array('i')
+        begin = ends[i - 1] if i else 0
+        return self._array(self._data, offset + 4 * begin, ends[i] - begin)
+
+    def matchfn(self, literals):
+        # type: (Iterable[bytes]) -> Optional[Callable[[int], bool]]
+        """Return a function telling whether the text of a revision may
+        contain all of `literals`, or None if they are too short to rule out
+        any revision"""
+        trigrams = set()
+        for literal in literals:
+            # fold like the indexed text, but an invalid sequence in a
+            # literal says nothing about the text around it
+            for part in _foldcase(literal).split(u'\ufffd'.encode('utf-8')):
+                trigrams.update(_trigrams(part))
+        if not trigrams:
+            return None
+        revs = set()
+        for segment in self._segments:
+            candidates = None
+            for postings in sorted((self._postings(segment, t)
+                                    for t in trigrams), key=len):
+                if candidates is None:
+                    candidates = set(postings)
+                else:
+                    candidates.intersection_update(postings)
+                if not candidates:
+                    break
+            revs.update(candidates)
+        # revisions added since the index was written are not covered
+        covered = len(self)
+        return lambda r: r >= covered or r in revs
+
+# -- Refs
+
+class gitrefs(object):
+    """
+    A snapshot of the refs, read in a single pass over packed-refs and the
+    loose refs, with annotated tags peeled to their commits.
+
+    packed-refs usually records peeled tags itself; the other refs are
+    peeled together, once per distinct target. The snapshot stays current
+    as long as packed-refs, HEAD and the directories of loose refs keep
+    their stat data, as git writes a loose ref by renaming a lock file over
+    it.
+    """
+    _maxdepth = 5
+
+    def __init__(self, gitrepo):
+        # type: (pygit2.Repository) -> None
+        self._gitrepo = gitrepo
+        path = gitrepo.path
+        # stat data of what the snapshot was read from
+        self._stamps = {}  # type: Dict[str, Any]
+        # ref -> hex, or 'ref: <ref>' for symbolic refs
+        self._values = values = {}  # type: Dict[str, str]
+        # ref -> hex of the commit, for the annotated tags of packed-refs
+        peeled = {}  # type: Dict[str, str]
+
+        data = self._read(os.path.join(path, 'packed-refs')) or b''
+        name = None
+        for line in data.splitlines():
+            if line.startswith(b'^'):
+                # the peeled value of the annotated tag above
+                peeled[name] = line[1:]
+            elif line and not line.startswith(b'#'):
+                hexnode, name = line.split(b' ', 1)
+                values[name] = hexnode
+
+        stack = ['refs']
+        while stack:
+            directory = stack.pop()
+            self._stamp(os.path.join(path, directory))
+            try:
+                names = os.listdir(os.path.join(path, directory))
+            except OSError:
+                continue
+            for base in names:
+                if base.endswith('.lock'):
+                    continue
+                name = directory + '/' + base
+                filename = os.path.join(path, name)
+                if os.path.isdir(filename):
+                    stack.append(name)
+                    continue
+                value = self._read(filename, stamp=False)
+                if value:
+                    # loose refs take precedence over packed ones
+                    values[name] = value.strip()
+                    peeled.pop(name, None)
+        self._head = (self._read(os.path.join(path, 'HEAD')) or b'').strip()
+
+        self._commits = commits = {}  # type: Dict[str, pygit2.Oid]
+        cache = {}
+        for name in values:
+            hexnode = self._resolve(values[name])
+            if hexnode is None:
+                continue
+            if name in peeled:
+                commits[name] = pygit2.Oid(hex=peeled[name])
+                continue
+            if hexnode not in cache:
+                cache[hexnode] = self._peel(hexnode)
+            if cache[hexnode] is not None:
+                commits[name] = cache[hexnode]
+
+    @staticmethod
+    def _statkey(filename):
+        # type: (str) -> Optional[Tuple[int, int, float]]
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def _stamp(self, filename):
+        # type: (str) -> None
+        self._stamps[filename] = self._statkey(filename)
+
+    def _read(self, filename, stamp=True):
+        # type: (str, bool) -> Optional[bytes]
+        # stat before reading, so that a concurrent change is seen later
+        if stamp:
+            self._stamp(filename)
+        try:
+            return util.readfile(filename)
+        except IOError:
+            return None
+
+    def current(self):
+        # type: () -> bool
+        """Whether the refs are still those of the snapshot"""
+        return all(self._statkey(filename) == key
+                   for filename, key in self._stamps.iteritems())
+
+    def _resolve(self, value):
+        # type: (str) -> Optional[str]
+        for i in xrange(self._maxdepth):
+            if not value.startswith(b'ref: '):
+                return value if len(value) == 40 else None
+            value = self._values.get(value[5:], b'')
+        return None
+
+    def _peel(self, hexnode):
+        # type: (str) -> Optional[pygit2.Oid]
+        try:
+            obj = self._gitrepo.get(hexnode)
+            while obj is not None and obj.type == pygit2.GIT_OBJ_TAG:
+                obj = self._gitrepo.get(obj.target)
+        except (ValueError, pygit2.GitError):
+            return None
+        if obj is None or obj.type != pygit2.GIT_OBJ_COMMIT:
+            # dangling, or pointing to a tree or a blob
+            return None
+        return obj.id
+
+    def values(self, prefix):
+        # type: (str) -> Dict[str, bytes]
+        """Return the refs under prefix as they were read, a hex node or
+        'ref: <name>' for symbolic refs, by full name"""
+        return {name: value for name, value in self._values.iteritems()
+                if name.startswith(prefix)}
+
+    def commits(self, prefix):
+        # type: (str) -> Dict[str, pygit2.Oid]
+        """Return the commits of the refs under prefix, by name without the
+        prefix. Symbolic refs, like origin/HEAD, are left out."""
+        values = self._values
+        return {name[len(prefix):]: commit
+                for name, commit in self._commits.iteritems()
+                if name.startswith(prefix) and
+                not values[name].startswith(b'ref: ')}
+
+    def head(self):
+        # type: () -> Optional[pygit2.Oid]
+        """Return the commit of HEAD, or None if the branch is unborn"""
+        if self._head.startswith(b'ref: '):
+            return self._commits.get(self._head[5:])
+        hexnode = self._resolve(self._head)
+        if hexnode is None:
+            return None
+        return self._peel(hexnode)
+
+    def tips(self):
+        # type: () -> List[pygit2.Oid]
+        """Return the commits of every ref, and of HEAD"""
+        tips = list(self._commits.itervalues())
+        head = self.head()
+        if head is not None:
+            tips.append(head)
+        return tips
+
+# -- Branch cache
+
+class gitbranchcache(object):
+    """
+    The tips of the branches, persisted in .git/gilded/branchmap-v1 along
+    with a key describing the refs they were read from.
+
+    The key covers the values of the branch refs in the ref snapshot, so
+    any change to them invalidates the cache, on disk and in memory. It is
+    only computed again when the snapshot is read again.
+    """
+    _filename = 'branchmap-v1'
+
+    def __init__(self, repo):
+        # type: (gitrepository) -> None
+        self._repo = repo
+        self._remotes = repo.ui.configbool('gilded', 'remote-branches')
+        self._key = None  # type: Optional[str]
+        self._branches = {}  # type: Dict[str, List[pygit2.Oid]]
+        # the snapshot the key was computed from
+        self._refs = None  # type: Optional[gitrefs]
+
+    def _refskey(self, refs):
+        # type: (gitrefs) -> str
+        digest = hashlib.sha1(b'remotes' if self._remotes else b'local')
+        prefixes = ['refs/heads/']
+        if self._remotes:
+            prefixes.append('refs/remotes/')
+        for prefix in prefixes:
+            for name, value in sorted(refs.values(prefix).iteritems()):
+                digest.update(b'%s\0%s\0' % (name, value))
+        return digest.hexdigest()
+
+    def _build(self):
+        # type: () -> Dict[str, List[pygit2.Oid]]
+        refs = self._repo.refsnapshot()
+        tips = refs.commits('refs/heads/')
+        if self._remotes:
+            tips.update(refs.commits('refs/remotes/'))
+        return {name: [tip] for name, tip in tips.iteritems()}
+
+    def _read(self, key):
+        # type: (str) -> Optional[Dict[str, List[pygit2.Oid]]]
+        try:
+            lines = self._repo.cachevfs.read(self._filename).splitlines()
+        except (IOError, OSError):
+            return None
+        if not lines or lines[0] != key:
+            return None
+        tips = {}
+        for line in lines[1:]:
+            hexnode, name = line.split(' ', 1)
+            tips[name] = [pygit2.Oid(hex=hexnode)]
+        return tips
+
+    def _write(self, key, tips):
+        # type: (str, Dict[str, List[pygit2.Oid]]) -> None
+        lines = [key]
+        for name, (tip,) in sorted(tips.iteritems()):
+            lines.append('%s %s' % (tip.hex, name))
+        try:
+            with self._repo.cachevfs(self._filename, 'wb',
+                                     atomictemp=True) as f:
+                f.write('\n'.join(lines) + '\n')
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write branch cache: %s\n"
+                                % stringutil.forcebytestr(inst))
+
+    def branchmap(self):
+        # type: () -> Dict[str, List[pygit2.Oid]]
+        refs = self._repo.refsnapshot()
+        if refs is self._refs:
+            return self._branches
+        key = self._refskey(refs)
+        if key != self._key:
+            tips = self._read(key)
+            if tips is None:
+                tips = self._build()
+                self._write(key, tips)
+            self._key, self._branches = key, tips
+        self._refs = refs
+        return self._branches
 
 # --
 
@@ -115,32 +1935,180 @@ class gitchangelog(object):
     def __init__(self, repo):
         self._repo = repo
         self._gitrepo = repo._repo
+        self.index = gitrevindex(repo)
+        # decoded commit metadata, by node
+        self._revisioncache = util.lrucachedict(
+            repo.ui.configint('gilded', 'revision-cache-size'))
+        # (function, rev, rev) -> merge base revisions
+        self._mergebasecache = {}
+        # pick up commits added since the last command
+        self.index.update()
 
-    def parentrevs(self, rev):
-        rev = oid(rev)
-        commit = self._gitrepo[rev]
-        nparents = len(commit.parents)
-        if nparents == 0:
-            p1 = p2 = node.nullrev
+    @propertycache
+    def filteredrevs(self):
+        # type: () -> Set[int]
+        """
+        The indexed commits which are no longer reachable from the refs.
+
+        Commits keep their revision when a reset, a rebase or a branch
+        deletion drops them, and git may have pruned them since. They are
+        filtered out like hidden changesets, so the revision numbers stay
+        stable but the commits are only visible when asked for by hash.
+        """
+        index = self.index
+        childindex = self.childindex
+        childindex.update()
+        tips = set(index.rev(t) for t in reftips(self._repo))
+        tips.discard(None)
+        self._tiprevs = tips
+        # a commit is unreachable if and only if it only leads to heads of
+        # the index which are not tips, so only walk down from those
+        orphans = [r for r in childindex.heads() if r not in tips]
+        filtered = set(walkrevs(index, orphans, tips)) if orphans else set()
+        childindex.filtered = filtered
+        return filtered
+
+    def _unfilter(self, rev):
+        # type: (int) -> None
+        """Make a filtered revision visible, with its ancestors"""
+        filtered = self.filteredrevs
+        filtered.difference_update(walkrevs(self.index, [rev],
+                                            self._tiprevs))
+
+    def __len__(self):
+        # like a filtered mercurial changelog, this is the span of the
+        # revisions, filtered ones included
+        return len(self.index)
+
+    def __iter__(self):
+        filtered = self.filteredrevs
+        if not filtered:
+            return iter(xrange(len(self.index)))
+        return (r for r in xrange(len(self.index)) if r not in filtered)
+
+    def __contains__(self, rev):
+        return 0 <= rev < len(self.index) and rev not in self.filteredrevs
+
+    def revs(self, start=0, stop=None):
+        """iterate over all rev in this revlog (from start to stop)"""
+        step = 1
+        length = len(self)
+        if stop is not None:
+            if start > stop:
+                step = -1
+            stop += step
+            if stop > length:
+                stop = length
         else:
-            assert nparents <= 2
-            p1 = OidProxy(commit.parents[0].id)
-            if nparents == 2:
-                p2 = OidProxy(commit.parents[1].id)
-            else:
-                p2 = node.nullrev
-        return p1, p2
+            stop = length
+        filtered = self.filteredrevs
+        return (r for r in xrange(start, stop, step) if r not in filtered)
+
+    def tiprev(self):
+        filtered = self.filteredrevs
+        for rev in xrange(len(self.index) - 1, nullrev - 1, -1):
+            if rev not in filtered:
+                return rev
+
+    def tip(self):
+        return self.node(self.tiprev())
+
+    def node(self, rev):
+        # type: (Union[int, OidProxy, pygit2.Oid]) -> pygit2.Oid
+        if isinstance(rev, (OidProxy, pygit2.Oid)):
+            return oid(rev)
+        return self.index.node(rev)
+
+    def hasnode(self, node):
+        try:
+            self.rev(node)
+            return True
+        except (TypeError, LookupError):
+            return False
 
-    def changelogrevision(self, rev):
-        if hasattr(rev, 'id'):
-            rev = rev.id
-        commit = self._gitrepo[rev]
+    def parents(self, node):
+        # type: (Union[bytes, pygit2.Oid]) -> Tuple[pygit2.Oid, pygit2.Oid]
+        return tuple(nullid if r == nullrev else self.node(r)
+                     for r in self.parentrevs(self._torev(node)))
+
+    def parentrevs(self, rev):
+        # type: (int) -> Tuple[int, int]
+        if rev < 0:
+            return nullrev, nullrev
+        index = self.index
+        return index.p1[rev], index.p2[rev]
+
+    def committime(self, rev):
+        # type: (int) -> int
+        """Return the commit time of a revision, from the commit-graph when
+        it covers the revision"""
+        node = self.node(rev)
+        graph = self.index.graph
+        if graph is not None:
+            pos = graph.position(node.raw)
+            if pos is not None:
+                return graph.committime(pos)
+        return self._gitrepo[node].commit_time
+
+    @propertycache
+    def metadata(self):
+        # type: () -> gitmetadatastore
+        return gitmetadatastore(self)
+
+    @propertycache
+    def childindex(self):
+        # type: () -> gitchildindex
+        return gitchildindex(self.index)
+
+    def _childindex(self):
+        # type: () -> gitchildindex
+        childindex = self.childindex
+        # the revision index grows when unindexed commits are looked up
+        childindex.update()
+        return childindex
+
+    def children(self, node):
+        # type: (pygit2.Oid) -> List[pygit2.Oid]
+        """find the children of a given node"""
+        return [self.node(r)
+                for r in self._childindex().children(self.rev(node))]
+
+    def descendants(self, revs):
+        # type: (Iterable[int]) -> Iterator[int]
+        """Generate the descendants of 'revs' in revision order.
+
+        Yield a sequence of revision numbers starting with a child of
+        some rev in revs, i.e., each revision is *not* considered a
+        descendant of itself."""
+        childindex = self._childindex()
+        # walk from the children, so that a rev is left out only if no other
+        # rev in revs leads to it
+        children = [c for r in revs for c in childindex.children(r)]
+        return iter(gitbitmapset(childindex.descendants(children)))
+
+    @propertycache
+    def textindex(self):
+        # type: () -> gittextindex
+        return gittextindex(self.metadata)
+
+    def _decode(self, commit):
+        # type: (pygit2.Commit) -> changelog._changelogrevision
         return changelog._changelogrevision(
             extra=changelog._defaultextra,
             user="%s <%s>" % (commit.author.name, commit.author.email),
             date=(commit.commit_time, commit.commit_time_offset),
             description=commit.message)
 
+    def changelogrevision(self, rev):
+        node = self.node(rev)
+        cache = self._revisioncache
+        try:
+            return cache[node]
+        except KeyError:
+            pass
+        c = cache[node] = self._decode(self._gitrepo[node])
+        return c
+
     def _partialmatch(self, id):
         try:
             return self._gitrepo.revparse_single(id).id
@@ -148,23 +2116,108 @@ class gitchangelog(object):
             return None
 
     def rev(self, node):
+        # type: (Union[bytes, pygit2.Oid]) -> OidProxy
         if isinstance(node, bytes):
-            return OidProxy(pygit2.Oid(raw=node))
-        elif isinstance(node, pygit2.Oid):
-            return OidProxy(node)
-        else:
+            node = pygit2.Oid(raw=node)
+        elif not isinstance(node, pygit2.Oid):
             raise TypeError(node)
+        index = self.index
+        rev = index.rev(node)
+        if rev is None:
+            # not reachable from a ref (or a tag object): index it now
+            try:
+                commit = self._gitrepo[node].peel(pygit2.Commit)
+            except (KeyError, ValueError, pygit2.GitError):
+                raise error.LookupError(node, '.git', _('no node'))
+            node = commit.id
+            index.update([node])
+            rev = index.rev(node)
+        elif rev in self.filteredrevs:
+            # an unreachable commit which was asked for, if git kept it
+            if node not in self._gitrepo:
+                raise error.LookupError(node, '.git', _('no node'))
+            self._unfilter(rev)
+        return OidProxy(node, rev)
+
+    def _torev(self, node):
+        # type: (Union[bytes, pygit2.Oid]) -> int
+        if node == nullid:
+            return nullrev
+        return self.rev(node)
+
+    def _mergebase(self, func, a, b):
+        # type: (Callable, int, int) -> List[int]
+        """Return func(parentrevs, a, b) from mercurial's ancestor module,
+        memoized per pair of revisions"""
+        key = (func, min(a, b), max(a, b))
+        cache = self._mergebasecache
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        if nullrev in (a, b):
+            revs = []
+        else:
+            revs = sorted(func(self.parentrevs, a, b))
+        cache[key] = revs
+        return revs
 
     def commonancestorsheads(self, a, b):
-        # ancestor = self._repo._repo.merge_base(a, b)
-        # parents = set(p.rev() for p in self._repo[x].parents())
-        # heads = revset.heads(self._repo, [], ["symbol", ancestor])
-        heads = self._repo.revs("heads(::%s and ::%s)" % (a, b))
-        return list(heads)
-
-    def findmissing(self, *args, **kwargs):
-        # FIXME: short-circuit this for now to get summary working
-        return []
+        # type: (Union[bytes, pygit2.Oid], Union[bytes, pygit2.Oid]) -> List[pygit2.Oid]
+        """calculate all the heads of the common ancestors of nodes a and b"""
+        a, b = self._torev(a), self._torev(b)
+        ancs = self._mergebase(ancestormod.commonancestorsheads, a, b)
+        return [self.node(r) for r in ancs]
+
+    def isancestor(self, a, b):
+        # type: (Union[bytes, pygit2.Oid], Union[bytes, pygit2.Oid]) -> bool
+        """return True if node a is an ancestor of node b"""
+        a, b = self._torev(a), self._torev(b)
+        return a in self._mergebase(ancestormod.commonancestorsheads, a, b)
+
+    def ancestor(self, a, b):
+        # type: (Union[bytes, pygit2.Oid], Union[bytes, pygit2.Oid]) -> Union[bytes, pygit2.Oid]
+        """calculate the "best" common ancestor of nodes a and b"""
+        a, b = self._torev(a), self._torev(b)
+        ancs = self._mergebase(ancestormod.ancestors, a, b)
+        if ancs:
+            # choose a consistent winner when there's a tie
+            return min(self.node(r) for r in ancs)
+        return nullid
+
+    def headrevs(self):
+        # type: () -> List[int]
+        """Return the revisions without children, in ascending order"""
+        childindex = self._childindex()
+        filtered = self.filteredrevs
+        heads = set(r for r in childindex.heads() if r not in filtered)
+        # a parent of a filtered revision may have no visible child left
+        for rev in filtered:
+            for parent in self.parentrevs(rev):
+                if (parent != nullrev and parent not in filtered and
+                        not childindex.children(parent)):
+                    heads.add(parent)
+        return sorted(heads)
+
+    def findmissingrevs(self, common=None, heads=None):
+        # type: (Optional[Iterable[int]], Optional[Iterable[int]]) -> List[int]
+        """Return the ancestors of heads that are not ancestors of common,
+        sorted by revision"""
+        if common is None:
+            common = [nullrev]
+        if heads is None:
+            heads = self.headrevs()
+        return list(_bitpositions(ancestorbits(self.index, heads, common)))
+
+    def findmissing(self, common=None, heads=None):
+        # type: (Optional[Iterable[bytes]], Optional[Iterable[bytes]]) -> List[pygit2.Oid]
+        """Return the ancestors of heads that are not ancestors of common,
+        sorted by revision"""
+        if common is not None:
+            common = [self._torev(n) for n in common]
+        if heads is not None:
+            heads = [self._torev(n) for n in heads]
+        return [self.node(r) for r in self.findmissingrevs(common, heads)]
 
 class gitchangectx(context.basectx):
     def __init__(self, repo, changeid='.'):
@@ -174,16 +2227,20 @@ class gitchangectx(context.basectx):
 
         try:
             if isinstance(changeid, pygit2.Oid):
-                self._node = changeid
-                self._rev = OidProxy(self._node)
+                self._rev = repo.changelog.rev(changeid)
+                self._node = self._rev.id
+                return
+            if isinstance(changeid, OidProxy):
+                self._node = changeid.id
+                self._rev = changeid
                 return
             if changeid in ['null', nullrev]:
                 self._node = nullid
                 self._rev = nullrev
                 return
-            if isinstance(changeid, OidProxy):
-                self._node = changeid.id
-                self._rev = changeid
+            if isinstance(changeid, int):
+                self._node = repo.changelog.node(changeid)
+                self._rev = OidProxy(self._node, changeid)
                 return
             # if hasattr(changeid, 'id'):
             #     self._node = changeid.id
@@ -197,8 +2254,13 @@ class gitchangectx(context.basectx):
                 or repo.local() and changeid == repo.dirstate.p1()):
                 # this is a hack to delay/avoid loading obsmarkers
                 # when we know that '.' won't be hidden
-                self._node = repo.dirstate.p1()
-                self._rev = OidProxy(self._node)
+                p1 = repo.dirstate.p1()
+                if p1 == nullid:
+                    self._node = nullid
+                    self._rev = nullrev
+                else:
+                    self._rev = repo.changelog.rev(p1)
+                    self._node = self._rev.id
                 return
             # if len(changeid) == 20:
             #     try:
@@ -272,7 +2334,7 @@ class gitchangectx(context.basectx):
                                                 % changeid)
         except error.FilteredRepoLookupError:
             raise
-        except IndexError:
+        except (IndexError, LookupError):
             pass
         raise error.RepoLookupError(
             _("unknown revision '%s'") % changeid)
@@ -284,6 +2346,13 @@ class gitchangectx(context.basectx):
             return cls in other.__mro__ or context.changectx in other.__mro__
         return NotImplemented
 
+    def __bytes__(self):
+        # node.short() can't slice an Oid. show the full node, like
+        # formatrevnode
+        return str(self._node)
+
+    __str__ = __bytes__
+
     def __hash__(self):
         try:
             return hash(self._rev)
@@ -335,6 +2404,12 @@ class gitchangectx(context.basectx):
             return [gitchangectx(repo, p1)]
         return [gitchangectx(repo, p1), gitchangectx(repo, p2)]
 
+    def p2(self):
+        parents = self._parents
+        if len(parents) == 2:
+            return parents[1]
+        return gitchangectx(self._repo, nullrev)
+
     def changeset(self):
         c = self._changeset
         return (
@@ -487,11 +2562,48 @@ class gitworkingctx(context.workingctx):
     #     return [gitchangectx(self._repo, self._repo._repo.head.target)]
 
     def _checklookup(self, files):
-        # because we don't save and track modification times, and therefore
-        # don't return them in gitindexmap.__getitem__, we end up with files
-        # in the "unsure" category.
-        print(files)
-        return [], [], []
+        # type: (List[str]) -> Tuple[List[str], List[str], List[str]]
+        """Compare the contents of files whose stat data is ambiguous with
+        their index entries, hashing them with hashblobs().
+
+        The clean files are returned as fixup, and dirstate.normal() then
+        stores their current stat data in the index."""
+        modified, deleted, fixup = [], [], []
+        index = self._repo.dirstate._map._map.index
+        wvfs = self._repo.wvfs
+        candidates = []
+        for f in sorted(files):
+            try:
+                entry = index[f]
+            except KeyError:
+                modified.append(f)
+                continue
+            try:
+                st = wvfs.lstat(f)
+            except OSError:
+                # a file became inaccessible in between: mark it as deleted,
+                # matching dirstate behavior
+                deleted.append(f)
+                continue
+            islink = entry.mode == pygit2.GIT_FILEMODE_LINK
+            if islink != util.statislink(st):
+                modified.append(f)
+            elif not islink and util.statisexec(st) != (
+                    entry.mode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE):
+                modified.append(f)
+            else:
+                candidates.append((f, entry.id.raw, islink))
+
+        ids = hashblobs(self._repo.ui, [(wvfs.join(f), islink)
+                                        for f, expected, islink in candidates])
+        for (f, expected, islink), blob in zip(candidates, ids):
+            if blob is None:
+                deleted.append(f)
+            elif blob != expected:
+                modified.append(f)
+            else:
+                fixup.append(f)
+        return sorted(modified), sorted(deleted), fixup
 
     @propertycache
     def _parents(self):
@@ -501,14 +2613,571 @@ class gitworkingctx(context.workingctx):
             p = p[:-1]
         return [gitchangectx(self._repo, x) for x in p]
 
+# -- Filesystem monitor
+
+class gitfsmonitor(object):
+    """
+    Narrow down the status of the working copy to the files watchman reports
+    as changed since the previous status, and the files which were not
+    clean then.
+
+    The watchman clock of the previous status and the files which were not
+    clean are stored in .git/gilded/, with the state of HEAD and of the
+    index they were computed against. When watchman lost track of the
+    changes, or HEAD, the index or the ignore rules changed behind gilded's
+    back, the whole working copy is crawled again. Index writes made through
+    the dirstate keep the state valid by remembering the files they touched.
+
+    The watchman client shipped with mercurial's fsmonitor extension is
+    used, and the crawl is the fallback whenever it is unavailable.
+    """
+    _filename = 'fsmonitor-v1'
+    _timeout = 2.0
+
+    def __init__(self, repo):
+        # type: (gitrepository) -> None
+        self._repo = repo
+        self._gitrepo = repo._repo
+        self._client = None
+        # clock to store with the result of the current status
+        self._clock = None
+
+    def _identity(self):
+        # type: () -> str
+        """Describe what the status depends on besides the working copy"""
+        gitrepo = self._gitrepo
+        try:
+            parts = [str(gitrepo.head.target)]
+        except pygit2.GitError:
+            parts = ['']
+        for name in ('index', 'info/exclude'):
+            try:
+                st = os.stat(os.path.join(gitrepo.path, name))
+            except OSError:
+                parts.append('')
+            else:
+                parts.append('%d:%r' % (st.st_size, st.st_mtime))
+        return ' '.join(parts)
+
+    def _read(self):
+        # type: () -> Optional[Tuple[str, str, List[str]]]
+        try:
+            data = self._repo.cachevfs.read(self._filename)
+        except (IOError, OSError):
+            return None
+        # clock\0identity\0file\0file...
+        fields = data.split('\0')
+        if len(fields) < 2:
+            return None
+        return fields[0], fields[1], [f for f in fields[2:] if f]
+
+    def _write(self, clock, files):
+        # type: (str, Iterable[str]) -> None
+        data = '\0'.join([clock, self._identity()] + sorted(files))
+        try:
+            with self._repo.cachevfs(self._filename, 'wb',
+                                     atomictemp=True) as f:
+                f.write(data)
+        except (IOError, OSError, error.Abort) as inst:
+            self._repo.ui.debug("couldn't write fsmonitor state: %s\n"
+                                % stringutil.forcebytestr(inst))
+
+    def _command(self, *args):
+        """Run a watchman command, or return None when watchman is not
+        available"""
+        try:
+            from hgext.fsmonitor import watchmanclient
+        except ImportError:
+            self._repo.ui.debug('fsmonitor: no watchman client\n')
+            return None
+        try:
+            if self._client is None:
+                self._client = watchmanclient.client(self._repo,
+                                                     timeout=self._timeout)
+            return self._client.command(*args)
+        except watchmanclient.Unavailable as inst:
+            self._repo.ui.debug('fsmonitor: %s\n' % inst)
+            return None
+
+    def changed(self):
+        # type: () -> Optional[Set[str]]
+        """
+        Return the files whose status may have changed since the previous
+        status, or None if the whole working copy must be crawled.
+        """
+        self._clock = None
+        state = self._read()
+        if state is None or state[1] != self._identity():
+            # get the clock before crawling, so that nothing changed during
+            # the crawl is missed next time
+            result = self._command('clock')
+            if result is not None:
+                self._clock = result['clock']
+            return None
+        clock, identity, files = state
+        result = self._command('query', {
+            'fields': ['name'],
+            'since': clock,
+            'expression': ['not', ['anyof', ['dirname', '.git'],
+                                   ['name', '.git', 'wholename']]],
+            'sync_timeout': int(self._timeout * 1000),
+            'empty_on_fresh_instance': True,
+        })
+        if result is None:
+            return None
+        self._clock = result['clock']
+        if result['is_fresh_instance']:
+            # watchman restarted, and doesn't know what changed
+            return None
+        changed = set(result['files'])
+        if any(f == '.gitignore' or f.endswith('/.gitignore')
+               for f in changed):
+            return None
+        changed.update(files)
+        return changed
+
+    def save(self, statuses):
+        # type: (Dict[str, int]) -> None
+        """Remember the files which are not clean, for the next status"""
+        if self._clock is not None:
+            self._write(self._clock, statuses)
+
+    def writeindex(self, write, touched):
+        # type: (Callable[[], None], Set[str]) -> None
+        """
+        Write the index with `write`, keeping the state valid when the only
+        files changed in the index are the touched ones.
+        """
+        state = self._read()
+        uptodate = state is not None and state[1] == self._identity()
+        write()
+        if uptodate:
+            clock, identity, files = state
+            self._write(clock, touched.union(files))
+
+# -- Content hashing
+
+# below this many stale files, status leaves the hashing to libgit2
+_MINHASHSTATUS = 64
+
+# the stage bits of git_index_entry.flags, set on conflicts
+_GIT_IDXENTRY_STAGEMASK = 0x3000
+
+def blobid(path, islink=False):
+    # type: (str, bool) -> Optional[bytes]
+    """
+    Return the raw id of the git blob holding the contents of a file, or the
+    target of a symlink, or None if it can't be read.
+
+    Files are memory-mapped rather than read, and hashlib releases the GIL
+    while hashing them.
+    """
+    try:
+        if islink:
+            data = os.readlink(path)
+            return hashlib.sha1('blob %d\0%s' % (len(data), data)).digest()
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            digest = hashlib.sha1('blob %d\0' % size)
+            if size:
+                # empty files can't be mapped
+                data = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    digest.update(data)
+                finally:
+                    data.close()
+            return digest.digest()
+    except (IOError, OSError):
+        return None
+
+def _blobids(files):
+    # type: (List[Tuple[str, bool]]) -> List[Optional[bytes]]
+    return [blobid(path, islink) for path, islink in files]
+
+def hashblobs(ui, files):
+    # type: (uimod.ui, List[Tuple[str, bool]]) -> List[Optional[bytes]]
+    """
+    Return the blob ids of (path, islink) pairs, like blobid().
+
+    The files are hashed in chunks by gilded.hash-workers threads, or
+    processes if gilded.hash-processes is set.
+    """
+    workers = ui.configint('gilded', 'hash-workers') or worker.countcpus()
+    if workers <= 1 or len(files) <= 1:
+        return _blobids(files)
+    # a few chunks per worker, to even out the file sizes
+    size = max(1, len(files) // (workers * 4))
+    chunks = [files[i:i + size] for i in xrange(0, len(files), size)]
+    if ui.configbool('gilded', 'hash-processes'):
+        executor = futures.ProcessPoolExecutor(workers)
+    else:
+        executor = futures.ThreadPoolExecutor(workers)
+    with executor:
+        return list(itertools.chain.from_iterable(
+            executor.map(_blobids, chunks)))
+
+def _sametime(seconds, itime):
+    # type: (float, Any) -> bool
+    # python 2 only has float times, which are about a microsecond off
+    return (int(seconds) == itime.seconds and
+            abs(seconds - itime.seconds - itime.nanoseconds * 1e-9) < 1e-6)
+
+def staleentries(gitrepo, index):
+    # type: (pygit2.Repository, pygit2.Index) -> List[str]
+    """
+    Return the tracked files whose size and mode match their index entry but
+    whose other stat data doesn't, or which changed after the index was
+    written.
+
+    libgit2 reads and hashes these one at a time to find out whether they
+    are modified, which is where status spends its time in a working copy
+    that was just copied or extracted.
+    """
+    ffi, C = pygit2.ffi, pygit2.C
+    config = gitrepo.config
+    trustctime = ('core.trustctime' not in config or
+                  config.get_bool('core.trustctime'))
+    try:
+        stamp = os.stat(os.path.join(gitrepo.path, 'index')).st_mtime
+    except OSError:
+        stamp = None
+    root = gitrepo.workdir
+    cindex = index._index
+    stale = []
+    for i in xrange(C.git_index_entrycount(cindex)):
+        entry = C.git_index_get_byindex(cindex, i)
+        if (entry.flags & _GIT_IDXENTRY_STAGEMASK or
+                entry.mode == pygit2.GIT_FILEMODE_COMMIT):
+            continue
+        path = ffi.string(entry.path)
+        try:
+            st = os.lstat(root + path)
+        except OSError:
+            # deleted
+            continue
+        if util.statislink(st):
+            mode = pygit2.GIT_FILEMODE_LINK
+        elif util.statisexec(st):
+            mode = pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+        else:
+            mode = pygit2.GIT_FILEMODE_BLOB
+        if mode != entry.mode or st.st_size & 0xffffffff != entry.file_size:
+            # modified, which libgit2 tells without reading the file
+            continue
+        if (st.st_ino & 0xffffffff == entry.ino and
+                st.st_uid == entry.uid and st.st_gid == entry.gid and
+                _sametime(st.st_mtime, entry.mtime) and
+                (not trustctime or _sametime(st.st_ctime, entry.ctime)) and
+                (stamp is None or st.st_mtime < stamp)):
+            continue
+        stale.append(path)
+    return stale
+
+# not exported by pygit2
+_GIT_DIFF_UPDATE_INDEX = 1 << 15
+
+# diff deltas as status flags, from HEAD to the index and from the index to
+# the working copy
+_INDEXDELTAS = {
+    pygit2.GIT_DELTA_ADDED: pygit2.GIT_STATUS_INDEX_NEW,
+    pygit2.GIT_DELTA_DELETED: pygit2.GIT_STATUS_INDEX_DELETED,
+    pygit2.GIT_DELTA_MODIFIED: pygit2.GIT_STATUS_INDEX_MODIFIED,
+    pygit2.GIT_DELTA_TYPECHANGE: pygit2.GIT_STATUS_INDEX_TYPECHANGE,
+}
+_WORKDIRDELTAS = {
+    pygit2.GIT_DELTA_DELETED: pygit2.GIT_STATUS_WT_DELETED,
+    pygit2.GIT_DELTA_MODIFIED: pygit2.GIT_STATUS_WT_MODIFIED,
+    pygit2.GIT_DELTA_TYPECHANGE: pygit2.GIT_STATUS_WT_TYPECHANGE,
+    pygit2.GIT_DELTA_UNTRACKED: pygit2.GIT_STATUS_WT_NEW,
+    pygit2.GIT_DELTA_IGNORED: pygit2.GIT_STATUS_IGNORED,
+}
+
+def diffstatus(gitrepo, index, pathspecs=None, unknown=True, ignored=False,
+               lookup=(), refresh=True):
+    # type: (pygit2.Repository, pygit2.Index, Optional[List[str]], bool, bool, Sequence[str], bool) -> Dict[str, int]
+    """
+    Return the status of the working copy like pygit2.Repository.status(),
+    but only under the given literal paths, and only looking for unknown
+    and ignored files when asked to.
+
+    pygit2 doesn't expose the options of git_status_list_new(), so the
+    status is put together from a diff of HEAD to the index, and a diff of
+    the index to the working copy, which take the same options.
+
+    Files found to be clean after comparing their contents get their stat
+    data refreshed, and libgit2 writes the index back, so that they are
+    not read again next time, unless refresh is False.
+
+    The files in lookup are left out of the comparison with the working
+    copy, for the caller to hash them. That runs against a copy of the
+    index, which can't be written, so nothing is refreshed then.
+    """
+    ffi, C = pygit2.ffi, pygit2.C
+    check_error = pygit2.errors.check_error
+    flags = pygit2.GIT_DIFF_INCLUDE_TYPECHANGE
+    if unknown or ignored:
+        # ignored files in unknown directories are only found by descending
+        # into them
+        flags |= (pygit2.GIT_DIFF_INCLUDE_UNTRACKED |
+                  pygit2.GIT_DIFF_RECURSE_UNTRACKED_DIRS)
+    if ignored:
+        flags |= (pygit2.GIT_DIFF_INCLUDE_IGNORED |
+                  pygit2.GIT_DIFF_RECURSE_IGNORED_DIRS)
+    if pathspecs is not None:
+        # paths, not fnmatch patterns
+        flags |= pygit2.GIT_DIFF_DISABLE_PATHSPEC_MATCH
+    try:
+        tree = gitrepo.head.peel(pygit2.Tree)
+    except pygit2.GitError:
+        # unborn branch
+        tree = None
+
+    workdirindex = index
+    lookup = set(lookup)
+    if lookup:
+        workdirindex = pygit2.Index()
+        for i in xrange(C.git_index_entrycount(index._index)):
+            entry = C.git_index_get_byindex(index._index, i)
+            if ffi.string(entry.path) not in lookup:
+                check_error(C.git_index_add(workdirindex._index, entry))
+
+    statuses = {}
+    with pygit2.utils.StrArray(pathspecs) as paths:
+        copts = ffi.new('git_diff_options *')
+        check_error(C.git_diff_init_options(copts, 1))
+        copts.flags = flags
+        if paths != ffi.NULL:
+            copts.pathspec = paths[0]
+
+        ctree = ffi.new('git_tree **')
+        if tree is not None:
+            ffi.buffer(ctree)[:] = tree._pointer[:]
+        cdiff = ffi.new('git_diff **')
+        check_error(C.git_diff_tree_to_index(cdiff, gitrepo._repo, ctree[0],
+                                             index._index, copts))
+        staged = pygit2.Diff.from_c(bytes(ffi.buffer(cdiff)[:]), gitrepo)
+
+        if refresh and not lookup:
+            copts.flags |= _GIT_DIFF_UPDATE_INDEX
+        cdiff = ffi.new('git_diff **')
+        check_error(C.git_diff_index_to_workdir(cdiff, gitrepo._repo,
+                                                workdirindex._index, copts))
+        unstaged = pygit2.Diff.from_c(bytes(ffi.buffer(cdiff)[:]), gitrepo)
+
+    skip = set()
+    if not unknown:
+        skip.add(pygit2.GIT_DELTA_UNTRACKED)
+    for diff, deltas in ((staged, _INDEXDELTAS), (unstaged, _WORKDIRDELTAS)):
+        for delta in diff.deltas:
+            status = deltas.get(delta.status)
+            if status is not None and delta.status not in skip:
+                path = delta.new_file.path
+                if diff is unstaged and path in lookup:
+                    # untracked in the copy
+                    continue
+                statuses[path] = statuses.get(path, 0) | status
+    return statuses
+
+# -- Index file
+
+# see Documentation/technical/index-format.txt in git
+_INDEX_ENTRY = struct.Struct('>10L20sH')
+_INDEX_EXTENDED = 0x4000
+_INDEX_NAMEMASK = 0xfff
+
+def _varint(data, offset):
+    # type: (Any, int) -> Tuple[int, int]
+    """Decode a variable-length integer in the offset encoding of packs and
+    index v4, and return it with the offset that follows"""
+    c = ord(data[offset])
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = ord(data[offset])
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+class gitindexfile(object):
+    """
+    A read-only, memory-mapped git index file, in versions 2 to 4.
+
+    Only the paths are decoded when the file is opened, in index order, with
+    the offset of each entry. The stat data is unpacked from the map when it
+    is asked for, rather than building an object per entry.
+    """
+    def __init__(self, path):
+        # type: (str) -> None
+        with open(path, 'rb') as f:
+            self.data = data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, self.version, count = struct.unpack_from('>4sII', data, 0)
+        if signature != b'DIRC' or not 2 <= self.version <= 4:
+            raise ValueError('unsupported index: %s' % path)
+        self.paths = paths = []  # type: List[str]
+        self._offsets = offsets = array.array('L')
+        unpack = struct.Struct('>H').unpack_from
+        compressed = self.version == 4
+        name = b''
+        offset = 12
+        for i in xrange(count):
+            offsets.append(offset)
+            flags, = unpack(data, offset + 60)
+            start = offset + 62
+            if flags & _INDEX_EXTENDED:
+                start += 2
+            if compressed:
+                # the path is stored as the number of bytes to remove from
+                # the end of the previous one, and what follows them
+                strip, start = _varint(data, start)
+                end = data.find(b'\0', start)
+                name = name[:len(name) - strip] + data[start:end]
+                offset = end + 1
+            else:
+                namelen = flags & _INDEX_NAMEMASK
+                if namelen == _INDEX_NAMEMASK:
+                    end = data.find(b'\0', start)
+                else:
+                    end = start + namelen
+                name = data[start:end]
+                # padded with 1 to 8 NUL bytes to a multiple of 8
+                offset += (end - offset + 8) & ~7
+            paths.append(name)
+        # extensions follow, up to the trailing checksum
+        while offset + 8 <= len(data) - 20:
+            extension, size = struct.unpack_from('>4sI', data, offset)
+            if extension in (b'link', b'sdir'):
+                # entries live in another file, or directories are folded
+                raise ValueError('unsupported index extension %s: %s'
+                                 % (extension, path))
+            offset += 8 + size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, path):
+        # type: (str) -> bool
+        i = bisect.bisect_left(self.paths, path)
+        return i < len(self.paths) and self.paths[i] == path
+
+    def stat(self, path):
+        # type: (str) -> Tuple[int, int, int]
+        """Return the mode, size and mtime of the stage 0 entry for path"""
+        paths = self.paths
+        i = bisect.bisect_left(paths, path)
+        # conflicts have an entry per stage, in order
+        while i < len(paths) and paths[i] == path:
+            (ctime, ctimens, mtime, mtimens, dev, ino, mode, uid, gid, size,
+             sha, flags) = _INDEX_ENTRY.unpack_from(self.data, self._offsets[i])
+            if not flags & _GIT_IDXENTRY_STAGEMASK:
+                return mode, size, mtime
+            i += 1
+        raise KeyError(path)
+
 class gitindexmap(collections.MutableMapping):
     """
     Wrap a pygit2 index in a mutable mapping where the values correspond to
     Mercurial's notion of file status.
+
+    The statuses come from a single snapshot of the whole working copy,
+    taken the first time one is needed, and writing the index drops it.
+
+    Changes made through the mapping are only recorded, and answered from
+    the record, until flush() applies them to the index as one batch and
+    updates the snapshot for them with a single diff. The index is written
+    once, and only if something changed.
+
+    Until the first change, paths and stat data are read from the index
+    file with gitindexfile, instead of through pygit2 entry objects.
     """
+    _states = [
+        (pygit2.GIT_STATUS_INDEX_NEW, 'a'),
+        (pygit2.GIT_STATUS_INDEX_DELETED, 'r'),
+        (pygit2.GIT_STATUS_WT_DELETED, 'n'),
+        # # FIXME: need to differentiate staged vs unstaged modified
+        (pygit2.GIT_STATUS_WT_MODIFIED, 'm'),
+        (pygit2.GIT_STATUS_INDEX_MODIFIED, 'm'),
+    ]
+
     def __init__(self, repo):
         self._repo = repo
         self._index = repo.index
+        # dirstate tuples, or None for deleted files, not applied yet
+        self._pending = collections.OrderedDict()
+        # files changed through the mapping since the index was written
+        self.touched = set()
+
+    @propertycache
+    def _statuses(self):
+        # type: () -> Dict[str, int]
+        # current files are left out
+        return self._repo.status()
+
+    @propertycache
+    def _file(self):
+        # type: () -> Optional[gitindexfile]
+        try:
+            return gitindexfile(os.path.join(self._repo.path, 'index'))
+        except (IOError, OSError, ValueError, struct.error):
+            # missing, empty, or in a format left to libgit2
+            return None
+
+    def _view(self):
+        # type: () -> Optional[gitindexfile]
+        # the file is behind the index once it is changed in memory
+        if self.touched:
+            return None
+        return self._file
+
+    def setstatuses(self, statuses):
+        # type: (Dict[str, int]) -> None
+        """Replace the snapshot with a fresh repo.status()"""
+        self._statuses = statuses
+
+    def closefile(self):
+        """Stop reading from the index file, after libgit2 rewrote it"""
+        util.clearcachedproperty(self, '_file')
+
+    def invalidate(self):
+        util.clearcachedproperty(self, '_statuses')
+
+    @property
+    def index(self):
+        # type: () -> pygit2.Index
+        """The pygit2 index, with the pending changes applied"""
+        self.flush()
+        return self._index
+
+    def flush(self):
+        """Apply the pending changes to the index in memory"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, collections.OrderedDict()
+        changed = []
+        for key, value in pending.iteritems():
+            if value is None or value[0] == 'r':
+                # marked for removal: untrack it, like `git rm --cached`
+                if key in self._index:
+                    self._index.remove(key)
+                    changed.append(key)
+            else:
+                blob = self._blob(key)
+                self._index.add(key)
+                # unless only the stat data changed, as for the clean files
+                # found by workingctx._checklookup()
+                if blob is None or blob != self._blob(key):
+                    changed.append(key)
+        if changed and '_statuses' in self.__dict__:
+            statuses = diffstatus(self._repo, self._index, sorted(changed),
+                                  refresh=False)
+            for key in changed:
+                status = statuses.get(key)
+                if status is None:
+                    self._statuses.pop(key, None)
+                else:
+                    self._statuses[key] = status
 
     def __getitem__(self, key):
         '''Return the current state of key (a filename) in the dirstate.
@@ -519,44 +3188,90 @@ class gitindexmap(collections.MutableMapping):
           r  marked for removal
           a  marked for addition
         '''
-        item = self._index[key]
-        status = self._repo.status_file(key)
+        if key in self._pending:
+            value = self._pending[key]
+            if value is None or value[0] == 'r':
+                raise KeyError(key)
+            return value
+        view = self._view()
+        if view is not None:
+            mode, size, mtime = view.stat(key)
+        else:
+            entry = pygit2.C.git_index_get_bypath(self._index._index, key, 0)
+            if entry == pygit2.ffi.NULL:
+                raise KeyError(key)
+            mode, size = entry.mode, entry.file_size
+            mtime = entry.mtime.seconds
+        status = self._statuses.get(key, pygit2.GIT_STATUS_CURRENT)
 
         if status == pygit2.GIT_STATUS_WT_NEW:
             # means untracked
             raise KeyError(key)
 
-        map = [
-            (pygit2.GIT_STATUS_INDEX_NEW, 'a'),
-            (pygit2.GIT_STATUS_INDEX_DELETED, 'r'),
-            (pygit2.GIT_STATUS_WT_DELETED, 'n'),
-            # # FIXME: need to differentiate staged vs unstaged modified
-            (pygit2.GIT_STATUS_WT_MODIFIED, 'm'),
-            (pygit2.GIT_STATUS_INDEX_MODIFIED, 'm'),
-        ]
-
+        # the stat data git recorded when the file was last known clean
         if status == pygit2.GIT_STATUS_CURRENT:
             # special-case bitmask 0
-            return ('n', item.mode, 0, 0)
+            return ('n', mode, size, mtime)
 
-        for gstat, hstat in map:
+        for gstat, hstat in self._states:
             if status & gstat:
-                return (hstat, item.mode, 0, 0)
+                if hstat == 'a':
+                    # like dirstate.add()
+                    return (hstat, mode, -1, -1)
+                return (hstat, mode, size, mtime)
 
         raise RuntimeError(key, status)
 
+    def __contains__(self, key):
+        if key in self._pending:
+            value = self._pending[key]
+            return value is not None and value[0] != 'r'
+        view = self._view()
+        if view is not None:
+            return key in view
+        return key in self._index
+
+    def _blob(self, key):
+        # type: (str) -> Optional[Tuple[int, bytes]]
+        entry = pygit2.C.git_index_get_bypath(self._index._index, key, 0)
+        if entry == pygit2.ffi.NULL:
+            return None
+        return entry.mode, pygit2.ffi.buffer(entry.id.id)[:]
+
     def __setitem__(self, key, value):
-        self._index.add(key)
+        self._pending[key] = value
+        self.touched.add(key)
 
     def __delitem__(self, key):
-        self._index.remove(key)
+        if key not in self:
+            raise KeyError(key)
+        self._pending[key] = None
+        self.touched.add(key)
 
     def __len__(self):
+        self.flush()
+        view = self._view()
+        if view is not None:
+            return len(view)
         return len(self._index)
 
     def __iter__(self):
-        for key in self._index:
-            yield key.path
+        self.flush()
+        view = self._view()
+        if view is not None:
+            return iter(view)
+        return (entry.path for entry in self._index)
+
+    def write(self):
+        self.flush()
+        if not self.touched:
+            # the index never changed in memory, or libgit2 wrote it
+            return
+        # libgit2 holds index.lock for the duration of the write
+        self._index.write()
+        self.touched.clear()
+        self.invalidate()
+        self.closefile()
 
 
 class gitdirstatemap(dirstatemod.dirstatemap):
@@ -589,6 +3304,18 @@ class gitdirstatemap(dirstatemod.dirstatemap):
         # self.read()
         return self._map
 
+    @propertycache
+    def _dirs(self):
+        # util.dirs() can only skip removed files in a dict, but the index
+        # holds no removed files anyway
+        return util.dirs(list(self._map))
+
+    def nonnormalentries(self):
+        '''Returns a set of filenames of non-normal entries, and of entries
+        from the other parent'''
+        nonnorm = set(f for f, s in self._map.iteritems() if s[0] != 'n')
+        return nonnorm, set()
+
     def parents(self):
         # type: () -> Tuple[bytes, bytes]
         if not self._parents:
@@ -600,11 +3327,16 @@ class gitdirstatemap(dirstatemod.dirstatemap):
 
         return self._parents
 
+    @propertycache
+    def identity(self):
+        # the index plays the part of .hg/dirstate
+        return util.filestat.frompath(os.path.join(self._repo.path, 'index'))
+
     def read(self):
         pass
 
     def write(self, st, now):
-        self._map._index.write()
+        self._map.write()
 
 
 class gitdirstate(dirstatemod.dirstate):
@@ -621,6 +3353,13 @@ class gitdirstate(dirstatemod.dirstate):
         # fixes issue with remove/forget
         return set()
 
+    @propertycache
+    def _fsmonitor(self):
+        # type: () -> Optional[gitfsmonitor]
+        if self._ui.configbool('gilded', 'fsmonitor'):
+            return gitfsmonitor(self._repo)
+        return None
+
     def branch(self):
         try:
             refname = self._repo._repo.head.name
@@ -632,7 +3371,12 @@ class gitdirstate(dirstatemod.dirstate):
 
     # FIXME: this is probably a bit too simplistic
     def write(self, rt):
-        self._map.write(None, None)
+        monitor = self._fsmonitor
+        if monitor is None:
+            self._map.write(None, None)
+            return
+        touched = set(self._map._map.touched)
+        monitor.writeindex(lambda: self._map.write(None, None), touched)
 
     def add(self, f):
         '''Mark a file added.'''
@@ -664,32 +3408,82 @@ class gitdirstate(dirstatemod.dirstate):
         lookup, modified, added, unknown, ignored = [], [], [], [], []
         removed, deleted, clean = [], [], []
 
-        madd = modified.append
-        aadd = added.append
-        uadd = unknown.append
-        iadd = ignored.append
-        radd = removed.append
-        dadd = deleted.append
-        cadd = clean.append
-        mexact = match.exact
-
-        map = {
-            pygit2.GIT_STATUS_INDEX_NEW: added.append,
-            pygit2.GIT_STATUS_INDEX_NEW | pygit2.GIT_STATUS_WT_MODIFIED: added.append,
-            pygit2.GIT_STATUS_WT_NEW: unknown.append,
-            pygit2.GIT_STATUS_CURRENT: clean.append,
-            pygit2.GIT_STATUS_IGNORED: ignored.append,
-            pygit2.GIT_STATUS_INDEX_DELETED: removed.append,
-            pygit2.GIT_STATUS_WT_DELETED: deleted.append,
+        # the first matching flag wins
+        kinds = [
+            (pygit2.GIT_STATUS_WT_DELETED, deleted),
+            (pygit2.GIT_STATUS_INDEX_DELETED, removed),
+            (pygit2.GIT_STATUS_INDEX_NEW, added),
             # FIXME: need to differentiate staged vs unstaged modified
-            pygit2.GIT_STATUS_WT_MODIFIED: modified.append,
-            pygit2.GIT_STATUS_INDEX_MODIFIED: modified.append,
-        }
-        statuses = self._repo._repo.status()
+            (pygit2.GIT_STATUS_INDEX_MODIFIED |
+             pygit2.GIT_STATUS_INDEX_TYPECHANGE |
+             pygit2.GIT_STATUS_WT_MODIFIED |
+             pygit2.GIT_STATUS_WT_TYPECHANGE, modified),
+            (pygit2.GIT_STATUS_WT_NEW, unknown),
+            (pygit2.GIT_STATUS_IGNORED, ignored),
+        ]
+
+        # only the explicit files and directories are scanned
+        pathspecs = None
+        if not match.always():
+            files = match.files()
+            if files and '' not in files and '.' not in files:
+                pathspecs = sorted(files)
+        monitor = None
+        if pathspecs is None and not listignored:
+            monitor = self._fsmonitor
+        indexmap = self._map._map
+        index = indexmap.index
+        if monitor is not None:
+            # unknown files are always looked for, as they must be
+            # remembered for the next status
+            changed = monitor.changed()
+            if changed is None:
+                statuses = diffstatus(self._repo._repo, index)
+            elif changed:
+                statuses = diffstatus(self._repo._repo, index,
+                                      sorted(changed))
+            else:
+                statuses = {}
+            monitor.save(statuses)
+            if not listunknown:
+                kinds = [k for k in kinds if k[1] is not unknown]
+        else:
+            stale = []
+            if pathspecs is None and self._ui.configbool('gilded',
+                                                         'hash-status'):
+                stale = staleentries(self._repo._repo, index)
+                if len(stale) < _MINHASHSTATUS:
+                    # not worth copying the index
+                    stale = []
+            statuses = diffstatus(self._repo._repo, index,
+                                  pathspecs, unknown=listunknown,
+                                  ignored=listignored, lookup=stale)
+            # left for workingctx._checklookup() to hash
+            lookup.extend(f for f in stale if match(f))
+        # libgit2 may have written refreshed stat data
+        indexmap.closefile()
+        if pathspecs is None:
+            # lookups in the dirstate map can reuse it for the rest of the
+            # command
+            indexmap.setstatuses(statuses)
 
         for path in sorted(statuses):
+            if not match(path):
+                continue
             status = statuses[path]
-            map[status](path)
+            for flags, files in kinds:
+                if status & flags:
+                    files.append(path)
+                    break
+
+        if listclean:
+            unsure = set(lookup)
+            for entry in index:
+                path = entry.path
+                if (path not in statuses and path not in unsure and
+                        match(path)):
+                    clean.append(path)
+            clean.sort()
         return (lookup, scmutil.status(modified, added, removed, deleted,
                                        unknown, ignored, clean))
 
@@ -746,14 +3540,17 @@ class gitnamespaces(namespaces.namespaces):
 
 
 class gitrepository(object):
-    def __init__(self, baseui, path, create=False, intents=None):
-        # type: (uimod.ui, str, bool, Any) -> None
+    def __init__(self, baseui, path, create=False, intents=None,
+                 readonly=False):
+        # type: (uimod.ui, str, bool, Any, bool) -> None
         self.requirements = set()
         self.filtername = None
         self._phasedefaults = []
         self._bookmarks = {}
         self.obsstore = False
         self._revbranchcache = None
+        # how many wlock() calls are open, like a reentrant lock
+        self._wlockdepth = 0
         # generic mapping between names and nodes
         self.names = gitnamespaces()
 
@@ -782,6 +3579,13 @@ class gitrepository(object):
         self.ui = baseui.copy()
         self.ui.copy = baseui.copy # prevent copying repo configuration
         self.vfs = vfsmod.vfs(self.path, cacheaudited=True)
+        # cachevfs: rooted at .git/gilded, used for gilded's own caches
+        self.cachevfs = vfsmod.vfs(self.vfs.join('gilded'), cacheaudited=True)
+        # a repository opened to compare with reads its caches, but leaves
+        # them alone
+        self.readonly = readonly
+        if readonly:
+            self.cachevfs = vfsmod.readonlyvfs(self.cachevfs)
         if (self.ui.configbool('devel', 'all-warnings') or
             self.ui.configbool('devel', 'check-locks')):
             self.vfs.audit = self._getvfsward(self.vfs.audit)
@@ -804,6 +3608,15 @@ class gitrepository(object):
 
         self._repo = pygit2.Repository(self.path)
 
+        # the git remotes are paths too, and origin is the default one
+        for remote in self._repo.remotes:
+            names = [remote.name]
+            if remote.name == 'origin':
+                names.append('default')
+            for name in names:
+                if remote.url and self.ui.config('paths', name) is None:
+                    self.ui.setconfig('paths', name, remote.url, 'git')
+
         # FIXME: move to propertycache
         self.dirstate = gitdirstate(self, self.ui, self.root)
 
@@ -815,7 +3628,13 @@ class gitrepository(object):
 
     def peer(self):
         # FIXME: create a peer object? use localpeer?
-        return self
+        if self.readonly:
+            return self
+        return gitrepository(self.baseui, self.root, readonly=True)
+
+    def listkeys(self, namespace):
+        # no pushkey namespaces, so no bookmarks to compare
+        return {}
 
     # unchanged
     def unfiltered(self):
@@ -922,10 +3741,8 @@ class gitrepository(object):
         return self._tagscache.tags
 
     def _findtags(self):
-        repo = self._repo
-        # strip refs/tags/
-        tags = {tn[10:]: repo.lookup_reference(tn).target
-                for tn in repo.references if tn.startswith('refs/tags/')}
+        # annotated tags are peeled to their commits
+        tags = self.refsnapshot().commits('refs/tags/')
         tagtypes = dict((tag, 'global') for tag in tags)
         return tags, tagtypes
 
@@ -944,27 +3761,54 @@ class gitrepository(object):
         # type: () -> List[Tuple[bytes, bytes]]
         '''return a list of tags ordered by revision'''
         if not self._tagscache.tagslist:
-            # FIXME: we don't sort by revision
-            self._tagscache.tagslist = list(self.tags().iteritems())
+            l = []
+            cl = self.changelog
+            for t, n in self.tags().iteritems():
+                try:
+                    r = cl.rev(n)
+                except error.LookupError:
+                    continue
+                l.append((r, t, n))
+            self._tagscache.tagslist = [(t, n.raw) for r, t, n in sorted(l)]
 
         return self._tagscache.tagslist
 
     def nodetags(self, node):
-        # type: (bytes) -> Any
-        return []
+        # type: (Union[bytes, pygit2.Oid]) -> List[bytes]
+        '''return the tags associated with a node'''
+        if not self._tagscache.nodetagscache:
+            nodetagscache = {}
+            for t, n in self._tagscache.tags.iteritems():
+                nodetagscache.setdefault(n, []).append(t)
+            for tags in nodetagscache.itervalues():
+                tags.sort()
+            self._tagscache.nodetagscache = nodetagscache
+        if isinstance(node, bytes):
+            node = pygit2.Oid(raw=node)
+        return self._tagscache.nodetagscache.get(node, [])
 
     def nodebookmarks(self, node):
         # type: (bytes) -> Any
         return []
 
-    # FIXME: cache this
+    def refsnapshot(self):
+        # type: () -> gitrefs
+        """Return the refs, reading them again only if they changed"""
+        refs = self.__dict__.get('_refs')
+        if refs is None or not refs.current():
+            refs = self._refs = gitrefs(self._repo)
+        return refs
+
+    @propertycache
+    def _branchcache(self):
+        # type: () -> gitbranchcache
+        return gitbranchcache(self)
+
     def branchmap(self):
         # type: () -> Dict[str, List[pygit2.Oid]]
         '''returns a dictionary {branch: [branchheads]} with branchheads
         ordered by increasing revision number'''
-        repo = self._repo
-        return {bname: [repo.branches[bname].target]
-                for bname in repo.branches.local}
+        return self._branchcache.branchmap()
 
     def branchheads(self, branch=None, start=None, closed=False):
         if branch is None:
@@ -1020,13 +3864,40 @@ class gitrepository(object):
 
     # --
 
+    def _cachelock(self):
+        """Take the lock of the caches in .git/gilded, which the caches that
+        are appended to hold while writing"""
+        vfs = self.cachevfs
+        if self.readonly:
+            raise error.LockUnavailable(errno.EROFS, os.strerror(errno.EROFS),
+                                        self.vfs.join('gilded'),
+                                        _('cache of %s') % self.root)
+        try:
+            vfs.makedirs()
+        except OSError as inst:
+            raise error.LockUnavailable(inst.errno, inst.strerror, vfs.base,
+                                        _('cache of %s') % self.root)
+        timeout = self.ui.configint('ui', 'timeout')
+        # waiting on another command to write the caches is not worth a
+        # warning: a warning timeout past the timeout only prints debug
+        # messages
+        return lockmod.trylock(self.ui, vfs, 'lock', timeout, timeout + 1,
+                               desc=_('cache of %s') % self.root)
+
     @contextlib.contextmanager
     def lock(self, wait=True):
         yield
 
     @contextlib.contextmanager
     def wlock(self, wait=True):
-        yield
+        self._wlockdepth += 1
+        try:
+            yield
+        finally:
+            self._wlockdepth -= 1
+        if self._wlockdepth:
+            # the outermost wlock() writes the index, once
+            return
         # if self.dirstate.pendingparentchange():
         #     self.dirstate.invalidate()
         # else:
@@ -1144,6 +4015,13 @@ class gitrepository(object):
         """Used by workingctx to get the list of post-dirstate-status hooks."""
         return []
 
+    def clearpostdsstatus(self):
+        """Used by workingctx to clear post-dirstate-status hooks."""
+
+    def currenttransaction(self):
+        # the index is written without transactions
+        return None
+
     def heads(self, start=None):
         assert start is None
         return [x[0] for x in self.branchmap().values()]
@@ -1156,54 +4034,233 @@ def instance(ui, path, create, intents=None):
 
 # --- Overrides ---
 
-class gitfullreposet(smartset.generatorset):
-    def __new__(cls, repo, iterasc=None, root=None, heads=None):
-        return super(gitfullreposet, cls).__new__(cls, None, iterasc)
+# bit positions set in each byte value
+_BYTEBITS = [tuple(i for i in xrange(8) if b >> i & 1) for b in xrange(256)]
+_BYTEBITSREV = [tuple(reversed(bits)) for bits in _BYTEBITS]
+
+def _bytestobits(data):
+    # type: (bytearray) -> int
+    # byte i holds revisions 8 * i to 8 * i + 7, lowest bit first
+    return int(bytes(data[::-1]).encode('hex') or '0', 16)
+
+def _bitstobytes(bits):
+    # type: (int) -> bytearray
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    return bytearray(digits.decode('hex')[::-1])
+
+def _revbits(revs):
+    # type: (Iterable[int]) -> int
+    """Return the revisions as the bits of an integer"""
+    data = bytearray()
+    for rev in revs:
+        if rev < 0:
+            raise ValueError('revision cannot be part of a bitmap: %d' % rev)
+        i = rev >> 3
+        if i >= len(data):
+            data.extend(bytearray(i + 1 - len(data)))
+        data[i] |= 1 << (rev & 7)
+    return _bytestobits(data)
+
+# the digit of each revision flag, as bytes 0 and 1
+_FLAGDIGITS = b'01' + bytes(bytearray(xrange(2, 256)))
+
+def _flagbits(flags):
+    # type: (bytearray) -> int
+    """Return the revisions whose byte in flags is 1 as the bits of an
+    integer"""
+    return int(bytes(flags[::-1]).translate(_FLAGDIGITS) or '0', 2)
+
+def _bitpositions(bits):
+    # type: (int) -> Iterator[int]
+    """Yield the positions of the bits set in an integer, in ascending order"""
+    table = _BYTEBITS
+    for i, byte in enumerate(_bitstobytes(bits)):
+        if byte:
+            base = i << 3
+            for bit in table[byte]:
+                yield base + bit
+
+def _asbits(s):
+    # type: (smartset.abstractsmartset) -> Optional[int]
+    """Return the revisions of a smartset as the bits of an integer, if that
+    does not require iterating over it"""
+    if isinstance(s, gitbitmapset):
+        return s._bits
+    if isinstance(s, smartset._spanset) and not s._hiddenrevs:
+        if 0 <= s._start <= s._end:
+            return ((1 << s._end) - 1) ^ ((1 << s._start) - 1)
+    return None
+
+def _bitsubset(subset, bits, condrepr):
+    # type: (smartset.abstractsmartset, int, Any) -> smartset.abstractsmartset
+    """Return the revisions of subset that are set in bits, in the order of
+    subset"""
+    subsetbits = _asbits(subset)
+    if subsetbits is not None:
+        return gitbitmapset(bits & subsetbits, subset.isascending(), condrepr)
+    return subset.filter(gitbitmapset(bits).__contains__, condrepr=condrepr,
+                         cache=False)
+
+class gitbitmapset(smartset.abstractsmartset):
+    """
+    A sorted set of revisions, stored as the bits of an integer.
 
-    def __init__(self, repo, iterasc=None, root=None, heads=None):
-        # type: (gitrepository, Optional[bool], Optional[OidProxy], Optional[Iterable[OidProxy]]) -> None
-        self.repo = repo
-        self.gitrepo = repo._repo
-        self.root = oid(root) if root is not None else None
-        if heads is not None:
-            self.heads = [oid(h) for h in heads]
-        else:
-            self.heads = [self.gitrepo.branches[branch].peel().id for branch
-                          in self.gitrepo.branches]
-        super(gitfullreposet, self).__init__(self._revgen(), iterasc=iterasc)
-
-    def _revgen(self):
-        order = pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE
-        walker = self.gitrepo.walk(None, order)
-        for head in self.heads:
-            walker.push(head)
-        if self.root is not None:
-            # to match mercurial, we want to hide the parents of root
-            for parent_id in self.gitrepo[self.root].parent_ids:
-                walker.hide(parent_id)
-        for i, x in enumerate(walker):
-            yield OidProxy(x.id, i)
-
-    def __contains__(self, item):
-        return True
+    As revisions are dense, intersection, union and difference with another
+    bitmap or a span of revisions are a single operation on the machine words
+    of the integers. Membership and iteration go through a byte array built
+    from the integer when first needed.
+    """
+    def __init__(self, bits=0, ascending=True, datarepr=None):
+        # type: (int, bool, Any) -> None
+        self._bits = bits
+        self._ascending = ascending
+        self._datarepr = datarepr
+
+    @classmethod
+    def fromrevs(cls, revs, ascending=True, datarepr=None):
+        # type: (Iterable[int], bool, Any) -> gitbitmapset
+        return cls(_revbits(revs), ascending, datarepr)
+
+    @propertycache
+    def _data(self):
+        # type: () -> bytearray
+        return _bitstobytes(self._bits)
+
+    def __nonzero__(self):
+        return bool(self._bits)
+
+    __bool__ = __nonzero__
+
+    def __len__(self):
+        return bin(self._bits).count('1')
+
+    def __contains__(self, rev):
+        data = self._data
+        i = rev >> 3
+        return 0 <= i < len(data) and bool(data[i] >> (rev & 7) & 1)
+
+    def fastasc(self):
+        table = _BYTEBITS
+        for i, byte in enumerate(self._data):
+            if byte:
+                base = i << 3
+                for bit in table[byte]:
+                    yield base + bit
+
+    def fastdesc(self):
+        table = _BYTEBITSREV
+        data = self._data
+        for i in xrange(len(data) - 1, -1, -1):
+            byte = data[i]
+            if byte:
+                base = i << 3
+                for bit in table[byte]:
+                    yield base + bit
+
+    def __iter__(self):
+        if self._ascending:
+            return self.fastasc()
+        return self.fastdesc()
+
+    def isascending(self):
+        return self._ascending
+
+    def isdescending(self):
+        return not self._ascending
+
+    def istopo(self):
+        return False
+
+    def min(self):
+        bits = self._bits
+        if not bits:
+            raise ValueError('arg is an empty sequence')
+        return (bits & -bits).bit_length() - 1
+
+    def max(self):
+        bits = self._bits
+        if not bits:
+            raise ValueError('arg is an empty sequence')
+        return bits.bit_length() - 1
+
+    def first(self):
+        if not self._bits:
+            return None
+        return self.min() if self._ascending else self.max()
+
+    def last(self):
+        if not self._bits:
+            return None
+        return self.max() if self._ascending else self.min()
+
+    def reverse(self):
+        self._ascending = not self._ascending
+
+    def sort(self, reverse=False):
+        self._ascending = not reverse
 
     def __and__(self, other):
-        """As self contains the whole repo, all of the other set should also be
-        in self. Therefore `self & other = other`.
+        bits = _asbits(other)
+        if bits is None:
+            return super(gitbitmapset, self).__and__(other)
+        return gitbitmapset(self._bits & bits, self._ascending,
+                            ('<and %r, %r>', self, other))
+
+    def __add__(self, other):
+        bits = _asbits(other)
+        # the union of two sets iterated in opposite directions is iterated
+        # as the first one, then the rest of the second one
+        if bits is None or other.isascending() != self._ascending:
+            return super(gitbitmapset, self).__add__(other)
+        return gitbitmapset(self._bits | bits, self._ascending,
+                            ('<or %r, %r>', self, other))
+
+    def __sub__(self, other):
+        bits = _asbits(other)
+        if bits is None:
+            return super(gitbitmapset, self).__sub__(other)
+        return gitbitmapset(self._bits & ~bits, self._ascending,
+                            ('<sub %r, %r>', self, other))
+
+    @encoding.strmethod
+    def __repr__(self):
+        d = {False: '-', True: '+'}[self._ascending]
+        s = smartset._formatsetrepr(self._datarepr)
+        if not s:
+            s = pycompat.byterepr(list(self))
+        return '<%s%s %s>' % (type(self).__name__, d, s)
 
-        This boldly assumes the other contains valid revs only.
-        """
-        # other not a smartset, make is so
-        if not util.safehasattr(other, 'isascending'):
-            # filter out hidden revision
-            # (this boldly assumes all smartset are pure)
-            #
-            # `other` was used with "&", let's assume this is a set like
-            # object.
-            other = smartset.baseset(other)
+class gitancestorset(gitbitmapset):
+    """
+    The ancestors of `heads`, inclusive, that are not ancestors of `hidden`,
+    walked from the parent table the first time the set is used.
 
-        other.sort(reverse=self.isdescending())
-        return other
+    Ancestors below `stoprev` are left out, and not walked.
+    """
+    def __init__(self, repo, heads, hidden=(), stoprev=0, ascending=False):
+        # type: (gitrepository, Iterable[int], Iterable[int], int, bool) -> None
+        self._repo = repo
+        cl = repo.changelog
+        torev = lambda r: cl.rev(r) if isinstance(r, pygit2.Oid) else r
+        self._heads = [torev(h) for h in heads]
+        self._hidden = [torev(h) for h in hidden]
+        self._stoprev = max(stoprev, 0)
+        self._ascending = ascending
+        self._datarepr = None
+
+    @propertycache
+    def _bits(self):
+        # type: () -> int
+        return ancestorbits(self._repo.changelog.index, self._heads,
+                            self._hidden, self._stoprev)
+
+    @encoding.strmethod
+    def __repr__(self):
+        d = {False: '-', True: '+'}[self._ascending]
+        return '<%s%s heads=%r hidden=%r>' % (type(self).__name__, d,
+                                              self._heads, self._hidden)
 
 
 def formatrevnode(ui, rev, node):
@@ -1234,18 +4291,78 @@ def reachableroots(repo, roots, heads, includepath=False):
     if not roots:
         return smartset.baseset()
 
+    minroot = roots.min()
     roots = list(roots)
     heads = list(heads)
 
-    assert len(roots) == 1
-
-    return gitfullreposet(repo, root=roots[0], heads=heads)
+    if not includepath:
+        # the walk stops at the first roots it meets, which only touches
+        # a fraction of the ancestors of heads
+        revs = smartset.baseset(
+            dagop._reachablerootspure(repo, minroot, roots, heads, False))
+        revs.sort()
+        return revs
+    # revisions are numbered topologically, so nothing below the lowest root
+    # can be on a path from a root
+    ancestors = gitancestorset(repo, heads, stoprev=minroot, ascending=True)
+    # walk down from the roots without leaving the ancestors of heads
+    childindex = repo.changelog._childindex()
+    return gitbitmapset(childindex.descendants(roots, within=ancestors))
 
 def revancestors(repo, revs, followfirst=False, startdepth=None,
                  stopdepth=None, cutfunc=None):
-    # type: (repository.completelocalrepository, smartset.abstractsmartset, bool, Any, Any, Any) -> smartset.fullreposet
-    revs = list(revs)
-    return gitfullreposet(repo, heads=revs)
+    # type: (repository.completelocalrepository, smartset.abstractsmartset, bool, Optional[int], Optional[int], Optional[Callable[[int], bool]]) -> smartset.abstractsmartset
+    """Like revlog.ancestors(), but supports additional options, includes
+    the given revs themselves, and returns a smartset
+
+    A plain walk returns a bitmap of all the ancestors. Depth bounds,
+    first-parent walks and cut functions walk the parent table lazily in
+    descending order instead, so the walk goes no further than the caller.
+    """
+    if (not followfirst and startdepth is None and stopdepth is None and
+            cutfunc is None):
+        return gitancestorset(repo, revs)
+    index = repo.changelog.index
+    p1, p2 = index.p1, index.p2
+    if followfirst:
+        pfunc = lambda rev: (p1[rev],)
+    else:
+        pfunc = lambda rev: (p1[rev], p2[rev])
+    if cutfunc is not None:
+        plainpfunc = pfunc
+        pfunc = lambda rev: [r for r in plainpfunc(rev) if not cutfunc(r)]
+        revs = revs.filter(lambda rev: not cutfunc(rev))
+    gen = dagop._walkrevtree(pfunc, revs, startdepth, stopdepth, reverse=True)
+    return smartset.generatorset(gen, iterasc=False)
+
+def revdescendants(repo, revs, followfirst, startdepth=None, stopdepth=None):
+    # type: (repository.completelocalrepository, smartset.abstractsmartset, bool, Optional[int], Optional[int]) -> smartset.abstractsmartset
+    """Like revlog.descendants() but supports additional options, includes
+    the given revs themselves, and returns a smartset
+
+    A plain walk returns a bitmap of all the descendants, walked from the
+    children index. Depth bounds and first-parent walks walk the children
+    index lazily in ascending order instead.
+    """
+    cl = repo.changelog
+    childindex = cl._childindex()
+    if not followfirst and startdepth is None and stopdepth is None:
+        return gitbitmapset(childindex.descendants(revs))
+    p1 = cl.index.p1
+    if followfirst:
+        cfunc = lambda rev: [c for c in childindex.children(rev)
+                             if p1[c] == rev]
+    else:
+        cfunc = childindex.children
+    gen = dagop._walkrevtree(cfunc, revs, startdepth, stopdepth, reverse=False)
+    return smartset.generatorset(gen, iterasc=True)
+
+def _sortdate(ctx):
+    # type: (context.basectx) -> int
+    rev = ctx.rev()
+    if rev is None:
+        return ctx.date()[0]
+    return ctx._repo.changelog.committime(rev)
 
 def _phase(repo, subset, *targets):
     """helper to select all rev in <targets> phases"""
@@ -1277,17 +4394,15 @@ node.hex = hex_
 context.hex = hex_
 dagop.reachableroots = reachableroots
 dagop.revancestors = revancestors
+dagop.revdescendants = revdescendants
 
 scmutil.formatrevnode = formatrevnode
 scmutil.meaningfulparents = meaningfulparents
 scmutil.casecollisionauditor = lambda *args, **kwargs: None
 
-smartset.fullreposet = gitfullreposet
-# spansets no longer make sense.
-# this will error if start/stop value is provided, but we want to know that.
-smartset.spanset = gitfullreposet
-
 revset._phase = _phase
+# avoid inflating every commit when sorting by date
+revset._sortkeyfuncs['date'] = _sortdate
 
 def overridepredicate(decl):
     """
@@ -1317,9 +4432,6 @@ def branch(repo, subset, x):
     Pattern matching is supported for `string`. See
     :hg:`help revisions.patterns`.
     """
-    def getbranchrevs(r):
-        return set(branches_with(repo._repo, r))
-
     # FIXME: look into sorting by branch name, to keep results stable
     branchrevs = set()
     revspec = False
@@ -1347,18 +4459,339 @@ def branch(repo, subset, x):
 
     if revspec:
         # get all the branches in x
-        s = revset.getset(repo, gitfullreposet(repo), x)
-        for r in s:
-            branchrevs.update(getbranchrevs(r))
+        s = revset.getset(repo, smartset.fullreposet(repo), x)
+        branchrevs.update(branches_with(repo, s))
 
     if not branchrevs:
         # FIXME: return empty set or subset?
         raise NotImplementedError
 
     brs = list(branchrevs)
-    s = gitfullreposet(repo, heads=brs)
+    s = gitancestorset(repo, brs)
     return subset & s
 
+@overridepredicate('children(set)')
+def children(repo, subset, x):
+    """Child changesets of changesets in set.
+    """
+    s = revset.getset(repo, smartset.fullreposet(repo), x)
+    childindex = repo.changelog._childindex()
+    cs = gitbitmapset.fromrevs(c for r in s for c in childindex.children(r))
+    return subset & cs
+
+@overridepredicate('only(set, [set])')
+def only(repo, subset, x):
+    """Changesets that are ancestors of the first set that are not ancestors
+    of any other head in the repo. If a second set is specified, the result
+    is ancestors of the first set that are not ancestors of the second set
+    (i.e. ::<set1> - ::<set2>).
+    """
+    cl = repo.changelog
+    # i18n: "only" is a keyword
+    args = revset.getargs(x, 1, 2, _('only takes one or two arguments'))
+    include = revset.getset(repo, smartset.fullreposet(repo), args[0])
+    if len(args) == 1:
+        if not include:
+            return smartset.baseset()
+        descendants = cl._childindex().descendants(include)
+        exclude = [rev for rev in cl.headrevs()
+                   if not descendants >> rev & 1]
+    else:
+        exclude = revset.getset(repo, smartset.fullreposet(repo), args[1])
+    # a single walk, which stops as soon as only excluded revisions remain
+    return subset & gitancestorset(repo, include, hidden=exclude)
+
+def _metadata(repo):
+    # type: (gitrepository) -> gitmetadatastore
+    meta = repo.changelog.metadata
+    meta.update()
+    return meta
+
+def _userset(repo, subset, n):
+    kind, pattern, matcher = revset._substringmatcher(n, casesensitive=False)
+    meta = _metadata(repo)
+    mask = meta.authormask(matcher)
+    # one pass over the author column, instead of a lookup per revision
+    bits = _flagbits(bytearray(itertools.imap(mask.__getitem__,
+                                              meta.authors)))
+    return _bitsubset(subset, bits, ('<user %r>', n))
+
+@overridepredicate('author(string)')
+def author(repo, subset, x):
+    """Alias for ``user(string)``.
+    """
+    n = revset.getstring(x, _("author requires a string"))
+    return _userset(repo, subset, n)
+
+@overridepredicate('user(string)')
+def user(repo, subset, x):
+    """User name contains string. The match is case-insensitive.
+
+    Pattern matching is supported for `string`. See
+    :hg:`help revisions.patterns`.
+    """
+    n = revset.getstring(x, _("user requires a string"))
+    return _userset(repo, subset, n)
+
+@overridepredicate('date(interval)')
+def date(repo, subset, x):
+    """Changesets within the interval, see :hg:`help dates`.
+    """
+    ds = revset.getstring(x, _("date requires a string"))
+    dm = dateutil.matchdate(ds)
+    times = _metadata(repo).times
+    bits = _flagbits(bytearray(itertools.imap(dm, times)))
+    return _bitsubset(subset, bits, ('<date %r>', ds))
+
+@overridepredicate('desc(string)')
+def desc(repo, subset, x):
+    """Search commit message for string. The match is case-insensitive.
+
+    Pattern matching is supported for `string`. See
+    :hg:`help revisions.patterns`.
+    """
+    ds = revset.getstring(x, _("desc requires a string"))
+    kind, pattern, matcher = revset._substringmatcher(ds, casesensitive=False)
+    meta = _metadata(repo)
+    if kind == 'literal':
+        literals = [pattern]
+    else:
+        literals = _requiredliterals(pattern)
+    maybe = _textcandidates(repo, literals)
+    bits = None
+    if maybe is None and kind == 'literal':
+        bits = meta.descsearch(pattern)
+    if bits is None:
+        description = meta.description
+        revs = xrange(len(meta))
+        if maybe is not None:
+            revs = itertools.ifilter(maybe, revs)
+        bits = _revbits(r for r in revs if matcher(description(r)))
+    return _bitsubset(subset, bits, ('<desc %r>', ds))
+
+def _textcandidates(repo, literals):
+    # type: (gitrepository, List[bytes]) -> Optional[Callable[[int], bool]]
+    """
+    Return a function ruling out the revisions whose author and message
+    cannot contain all of `literals`, or None if the text index is not used
+    or can't rule anything out
+    """
+    if repo.ui.configbool('gilded', 'text-index'):
+        index = repo.changelog.textindex
+        index.update()
+        return index.matchfn(literals)
+    return None
+
+def _textfilter(repo, literals):
+    # type: (gitrepository, List[bytes]) -> Callable[[int], bool]
+    """Like _textcandidates(), with a function ruling out nothing instead
+    of None"""
+    maybe = _textcandidates(repo, literals)
+    if maybe is None:
+        return lambda r: True
+    return maybe
+
+def _textfields(repo):
+    # type: (gitrepository) -> Callable[[int], List[bytes]]
+    # FIXME: gilded does not report the files of a commit yet, so only the
+    # author and the message are searched
+    meta = _metadata(repo)
+    names = meta.names
+    authors = meta.authors
+    description = meta.description
+    return lambda r: [names[authors[r]], description(r)]
+
+@overridepredicate('grep(regex)')
+def grep(repo, subset, x):
+    """Like ``keyword(string)`` but accepts a regex. Use ``grep(r'...')``
+    to ensure special escape characters are handled correctly. Unlike
+    ``keyword(string)``, the match is case-sensitive.
+    """
+    try:
+        # i18n: "grep" is a keyword
+        gr = re.compile(revset.getstring(x, _("grep requires a string")))
+    except re.error as e:
+        raise error.ParseError(
+            _('invalid match pattern: %s') % stringutil.forcebytestr(e))
+    fields = _textfields(repo)
+    maybe = _textfilter(repo, _requiredliterals(gr.pattern))
+
+    def matches(r):
+        return maybe(r) and any(gr.search(e) for e in fields(r))
+    return subset.filter(matches, condrepr=('<grep %r>', gr.pattern))
+
+@overridepredicate('keyword(string)')
+def keyword(repo, subset, x):
+    """Search commit message, user name, and names of changed files for
+    string. The match is case-insensitive.
+
+    For a regular expression or case sensitive search of these fields, use
+    ``grep(regex)``.
+    """
+    # i18n: "keyword" is a keyword
+    kw = revset.getstring(x, _("keyword requires a string"))
+    fields = _textfields(repo)
+    maybe = _textfilter(repo, [kw])
+    # fold the same way the text index does
+    kw = _foldcase(kw)
+
+    def matches(r):
+        return maybe(r) and any(kw in _foldcase(t) for t in fields(r))
+    return subset.filter(matches, condrepr=('<keyword %r>', kw))
+
+@command('debugrebuildtextindex', [], '')
+def debugrebuildtextindex(ui, repo):
+    """rebuild the trigram index of commit authors and messages"""
+    index = repo.changelog.textindex
+    index.rebuild()
+    ui.status(_('indexed %d revisions\n') % len(index))
+
+# -- Incoming and outgoing
+
+def findincoming(repo, other, heads):
+    # type: (gitrepository, gitrepository, Iterable[int]) -> Tuple[List[int], List[int]]
+    """
+    Compare repo with another local repository.
+
+    Return the revisions of `other` that are reachable from `heads` and
+    missing from `repo`, in ascending order, and the revisions of `repo`
+    where the walk met commits it already has. The walk goes down the parent
+    table of `other` and stops at the first known commits, so it only visits
+    the missing commits and their parents.
+    """
+    cl = repo.changelog
+    index = other.changelog.index
+    p1, p2 = index.p1, index.p2
+    missing = []
+    common = []
+    stack = [r for r in heads if r != nullrev]
+    seen = set(stack)
+    while stack:
+        rev = stack.pop()
+        node = index.node(rev)
+        if cl.hasnode(node):
+            common.append(cl.rev(node))
+            continue
+        missing.append(rev)
+        for parent in (p1[rev], p2[rev]):
+            if parent != nullrev and parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+    missing.sort()
+    return missing, common
+
+def _otherrepo(ui, repo, source, defaults, push=False):
+    # type: (uimod.ui, gitrepository, Optional[str], Tuple[str, ...], bool) -> Tuple[str, gitrepository]
+    """
+    Open the repository to compare with, given as a path, a name from the
+    [paths] section, or the name of a git remote. The default paths fall
+    back to the "origin" remote.
+    """
+    remotes = dict((r.name, r.url) for r in repo._repo.remotes)
+    names = [source] if source else list(defaults)
+    if not source or source in defaults:
+        names.append('origin')
+    for name in names:
+        if name in ui.paths:
+            path = ui.paths[name]
+            loc = push and path.pushloc or path.loc
+            break
+        if name in remotes:
+            loc = remotes[name]
+            break
+    else:
+        if not source or source in defaults:
+            raise error.Abort(_('default repository not configured!'),
+                              hint=_("see 'hg help config.paths'"))
+        loc = source
+    u = util.url(loc)
+    if not u.islocal():
+        raise error.Abort(_('cannot compare with %s') % util.hidepassword(loc),
+                          hint=_('only local repositories are supported'))
+    path = u.localpath()
+    if os.path.basename(os.path.normpath(path)) == '.git':
+        path = os.path.dirname(os.path.normpath(path))
+    ui.status(_('comparing with %s\n') % util.hidepassword(loc))
+    return loc, gitrepository(repo.baseui, path, readonly=True)
+
+def _headrevs(repo, opts):
+    # type: (gitrepository, Dict[str, Any]) -> List[int]
+    """Return the requested revisions of repo, or its branch tips"""
+    specs = list(opts.get('rev') or []) + list(opts.get('branch') or [])
+    if specs:
+        return list(scmutil.revrange(repo, specs))
+    cl = repo.changelog
+    return [cl.rev(n) for n in branchtips(repo)]
+
+_hgfindcommonincoming = discovery.findcommonincoming
+_hgfindcommonoutgoing = discovery.findcommonoutgoing
+
+def findcommonincoming(repo, remote, heads=None, force=False,
+                       ancestorsof=None):
+    """Replacement of mercurial.discovery.findcommonincoming for a local
+    git repository"""
+    if not isinstance(remote, gitrepository):
+        return _hgfindcommonincoming(repo, remote, heads, force, ancestorsof)
+    if not heads:
+        heads = reftips(remote)
+    rcl = remote.changelog
+    missing, common = findincoming(repo, remote, [rcl.rev(n) for n in heads])
+    cl = repo.changelog
+    return [cl.node(r) for r in common] or [nullid], bool(missing), heads
+
+def findcommonoutgoing(repo, other, onlyheads=None, force=False,
+                       commoninc=None, portable=False):
+    """Replacement of mercurial.discovery.findcommonoutgoing for a local
+    git repository"""
+    if not isinstance(other, gitrepository):
+        return _hgfindcommonoutgoing(repo, other, onlyheads, force,
+                                     commoninc, portable)
+    if commoninc is None:
+        commoninc = findcommonincoming(repo, other, force=force)
+    cl = repo.changelog
+    heads = [cl.rev(n) for n in onlyheads or branchtips(repo)]
+    common = [cl.rev(n) for n in commoninc[0] if n != nullid]
+    og = discovery.outgoing(repo, commoninc[0], [cl.node(r) for r in heads])
+    og.missing = [cl.node(r)
+                  for r in cl.findmissingrevs(common=common, heads=heads)]
+    return og
+
+def _outgoing(ui, repo, dest, opts):
+    # type: (uimod.ui, gitrepository, Optional[str], Dict[str, Any]) -> Tuple[List[pygit2.Oid], gitrepository]
+    """Replacement of mercurial.hg._outgoing for a local git repository"""
+    loc, other = _otherrepo(ui, repo, dest, ('default-push', 'default'),
+                            push=True)
+    cl = repo.changelog
+    heads = [cl.node(r) for r in _headrevs(repo, opts)]
+    missing = findcommonoutgoing(repo, other, onlyheads=heads).missing
+    if not missing:
+        ui.status(_("no changes found\n"))
+    return missing, other
+
+def _incoming(displaychlist, subreporecurse, ui, repo, source, opts,
+              buffered=False):
+    """Replacement of mercurial.hg._incoming for a local git repository"""
+    if opts.get('bundle'):
+        raise error.Abort(_('--bundle is not supported'))
+    loc, other = _otherrepo(ui, repo, source, ('default',))
+    ocl = other.changelog
+    chlist = [ocl.node(r)
+              for r in findincoming(repo, other, _headrevs(other, opts))[0]]
+    if not chlist:
+        ui.status(_("no changes found\n"))
+        return subreporecurse()
+    ui.pager('incoming')
+    displayer = logcmdutil.changesetdisplayer(ui, other, opts,
+                                              buffered=buffered)
+    displaychlist(other, chlist, displayer)
+    displayer.close()
+    subreporecurse()
+    return 0 # exit code is zero since we found incoming changes
+
 
 import mercurial.hg
 mercurial.hg.localrepo = sys.modules[__name__]
+mercurial.hg._incoming = _incoming
+mercurial.hg._outgoing = _outgoing
+discovery.findcommonincoming = findcommonincoming
+discovery.findcommonoutgoing = findcommonoutgoing
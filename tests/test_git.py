@@ -0,0 +1,428 @@
+"""
+Tests which need a git repository of their own, because they change it.
+
+Each test works on a fresh clone of the gittest fixture.
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+
+import pytest
+
+HG = ['hg', '--config', 'extensions.gilded=']
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Chad Dombrova',
+    'GIT_AUTHOR_EMAIL': 'chad@noemail.com',
+    'GIT_COMMITTER_NAME': 'Chad Dombrova',
+    'GIT_COMMITTER_EMAIL': 'chad@noemail.com',
+}
+
+
+def git(repodir, *args):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.check_output(['git', '-C', repodir] + list(args),
+                                   env=env)
+
+
+def hg(repodir, *args):
+    return subprocess.check_output(HG + list(args) + ['--traceback',
+                                                      '-R', repodir])
+
+
+def log(repodir, revset, template="{desc}\n", config=()):
+    args = []
+    for item in config:
+        args.extend(['--config', item])
+    return hg(repodir, 'log', '-r', revset, '--template', template,
+              *args).splitlines()
+
+
+@pytest.fixture
+def clone(request, tmpdir):
+    datadir = os.path.dirname(request.module.__file__)
+    repodir = str(tmpdir.join('clone'))
+    subprocess.check_call(['git', 'clone', '-q',
+                           os.path.join(datadir, 'gittest'), repodir])
+    yield repodir
+
+
+def test_unreachable_commits(clone):
+    heads = log(clone, "heads(all())")
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'dropped')
+    dropped = git(clone, 'rev-parse', 'HEAD').strip()
+    assert 'dropped' in log(clone, "heads(all())")
+
+    git(clone, 'reset', '-q', '--hard', 'HEAD~1')
+    assert 'dropped' not in log(clone, "all()")
+    assert log(clone, "heads(all())") == heads
+    # still there when asked for by hash, until git prunes it
+    assert log(clone, dropped) == ['dropped']
+
+    git(clone, 'reflog', 'expire', '--expire=now', '--all')
+    git(clone, 'gc', '-q', '--prune=now')
+    assert 'dropped' not in log(clone, "all()")
+    assert log(clone, "heads(all())") == heads
+    assert log(clone, "desc('dropped')") == []
+
+
+def test_concurrent_indexing(clone):
+    for i in range(3):
+        git(clone, 'commit', '-q', '--allow-empty', '-m', 'new %d' % i)
+    template = "{rev} {node}\n"
+    procs = [subprocess.Popen(HG + ['log', '-r', 'all()', '--template',
+                                    template, '-R', clone],
+                              stdout=subprocess.PIPE)
+             for i in range(4)]
+    outputs = [p.communicate()[0] for p in procs]
+    assert all(p.returncode == 0 for p in procs)
+    # every command numbered the commits the same way, and it stuck
+    expected = hg(clone, 'log', '-r', 'all()', '--template', template)
+    assert outputs == [expected] * len(procs)
+
+
+@pytest.mark.parametrize('textindex', [False, True])
+def test_renumbered_index(clone, textindex):
+    config = ['gilded.text-index=%s' % textindex]
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'dropped')
+    # fill the caches keyed by revision
+    assert log(clone, "desc('dropped')", config=config) == ['dropped']
+
+    git(clone, 'reset', '-q', '--hard', 'HEAD~1')
+    # lose the revision index, as if it had been discarded
+    os.remove(os.path.join(clone, '.git', 'gilded', 'revs-v2'))
+    git(clone, 'checkout', '-q', '-b', 'side', 'HEAD~1')
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'kept')
+    # 'kept' may take the revision 'dropped' had, on another parent
+    assert log(clone, "children(master)", config=config) == []
+    assert 'kept' in log(clone, "children(master~1)", config=config)
+    assert log(clone, "desc('dropped')", config=config) == []
+    assert log(clone, "desc('kept')", config=config) == ['kept']
+    assert log(clone, "user('Chad') and desc('kept')", config=config) == \
+        ['kept']
+
+
+def test_isancestor(clone):
+    import gilded
+    from mercurial import scmutil, ui as uimod
+    repo = gilded.instance(uimod.ui.load(), clone, False)
+    cl = repo.changelog
+    a = scmutil.revsymbol(repo, 'v1.0').node()
+    b = scmutil.revsymbol(repo, 'master').node()
+    for x, y in [(a, b), (a.raw, b.raw)]:
+        assert cl.isancestor(x, y)
+        assert not cl.isancestor(y, x)
+        assert cl.isancestor(x, x)
+
+
+# -- Working copy status
+
+# git status --porcelain codes, index then working copy, in hg's terms
+GIT_STATUS = [
+    ('??', '?'),
+    ('A', 'A'),
+    ('D', 'R'),
+    (' D', '!'),
+    ('M', 'M'),
+    (' M', 'M'),
+]
+
+
+def status(repodir, *args, **kwargs):
+    config = kwargs.pop('config', ())
+    cmd = HG + ['status', '-T', '{status} {path}\n']
+    for item in config:
+        cmd.extend(['--config', item])
+    # paths are printed relative to the working directory
+    output = subprocess.check_output(cmd + list(args), cwd=repodir)
+    return sorted(output.splitlines())
+
+
+def gitstatus(repodir, *args):
+    """git status, with the codes and paths hg status would print"""
+    result = {}
+    for line in git(repodir, 'status', '--porcelain', '--', *args).splitlines():
+        code, path = line[:2], line[3:]
+        for prefix, hgcode in GIT_STATUS:
+            if code.startswith(prefix):
+                # a forgotten file left in place is only reported as removed
+                if result.get(path) != 'R':
+                    result[path] = hgcode
+                break
+    return sorted('%s %s' % (code, path) for path, code in result.items())
+
+
+def changefiles(repodir):
+    with open(os.path.join(repodir, 'file-A.txt'), 'a') as f:
+        f.write('modified\n')
+    os.remove(os.path.join(repodir, 'subdir', 'file-C.txt'))
+    for name in ['added.txt', 'unknown.txt', 'subdir/unknown.txt']:
+        with open(os.path.join(repodir, name), 'w') as f:
+            f.write('new\n')
+    hg(repodir, 'add', os.path.join(repodir, 'added.txt'))
+    hg(repodir, 'forget', os.path.join(repodir, 'subdir', 'file-D.txt'))
+
+
+@pytest.mark.parametrize('config', [
+    [],
+    ['gilded.hash-status=True'],
+    # watchman is not required: without it, every status is a full crawl
+    ['gilded.fsmonitor=True'],
+])
+def test_status(clone, config):
+    assert status(clone, config=config) == []
+    changefiles(clone)
+    expected = gitstatus(clone)
+    assert expected == ['! subdir/file-C.txt',
+                        '? subdir/unknown.txt',
+                        '? unknown.txt',
+                        'A added.txt',
+                        'M file-A.txt',
+                        'R subdir/file-D.txt']
+    assert status(clone, config=config) == expected
+    # again, from what the first one saved
+    assert status(clone, config=config) == expected
+    assert status(clone, 'subdir', config=config) == gitstatus(clone,
+                                                               'subdir')
+
+
+def test_status_pathspec(clone):
+    import gilded
+    import pygit2
+    changefiles(clone)
+    gitrepo = pygit2.Repository(clone)
+    statuses = gilded.diffstatus(gitrepo, gitrepo.index, ['subdir'])
+    assert sorted(statuses) == ['subdir/file-C.txt', 'subdir/file-D.txt',
+                                'subdir/unknown.txt']
+
+
+def settimes(repodir, paths, offset):
+    """move the times of paths back by offset seconds, so they look stale"""
+    for path in paths:
+        path = os.path.join(repodir, path)
+        mtime = os.stat(path).st_mtime - offset
+        os.utime(path, (mtime, mtime))
+
+
+def test_status_refresh(clone):
+    import gilded
+    import pygit2
+    paths = git(clone, 'ls-files').splitlines()
+    settimes(clone, paths, 3600)
+    gitrepo = pygit2.Repository(clone)
+    assert sorted(gilded.staleentries(gitrepo, gitrepo.index)) == paths
+    assert status(clone) == []
+    # libgit2 wrote the stat data of the clean files back to the index
+    gitrepo = pygit2.Repository(clone)
+    assert gilded.staleentries(gitrepo, gitrepo.index) == []
+
+
+@pytest.mark.parametrize('workers,processes', [
+    (1, False),
+    (4, False),
+    (4, True),
+])
+def test_hash_status(clone, workers, processes):
+    paths = ['many/%03d.txt' % i for i in range(100)]
+    os.mkdir(os.path.join(clone, 'many'))
+    for path in paths:
+        with open(os.path.join(clone, path), 'w') as f:
+            f.write('%s\n' % path)
+    git(clone, 'add', 'many')
+    git(clone, 'commit', '-q', '-m', 'many')
+    # more stale files than libgit2 is left to hash, a few of them changed
+    # without changing size
+    for path in paths[::30]:
+        with open(os.path.join(clone, path), 'w') as f:
+            f.write('%s\n' % path.upper())
+    settimes(clone, paths, 3600)
+    config = ['gilded.hash-status=True',
+              'gilded.hash-workers=%d' % workers,
+              'gilded.hash-processes=%s' % processes]
+    expected = ['M %s' % path for path in paths[::30]]
+    assert gitstatus(clone) == expected
+    assert status(clone, config=config) == expected
+    assert status(clone, config=config) == expected
+
+
+def gitindexentries(repodir):
+    """the mode, size and mtime of each entry, as git reads them"""
+    modes = {}
+    for line in git(repodir, 'ls-files', '-s').splitlines():
+        info, path = line.split('\t', 1)
+        modes[path] = int(info.split()[0], 8)
+    entries = []
+    for line in git(repodir, 'ls-files', '--debug').splitlines():
+        if not line.startswith(' '):
+            path = line
+        elif line.strip().startswith('mtime:'):
+            mtime = int(line.split()[1].split(':')[0])
+        elif line.strip().startswith('size:'):
+            size = int(line.split()[1])
+            entries.append((path, (modes[path], size, mtime)))
+    return entries
+
+
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_index_file(clone, version):
+    import gilded
+    os.mkdir(os.path.join(clone, 'a-much-longer-directory-name'))
+    for name in ['a-much-longer-directory-name/file.txt',
+                 'a-much-longer-directory-name/other.txt', 'z.txt']:
+        with open(os.path.join(clone, name), 'w') as f:
+            f.write('%s\n' % name)
+    git(clone, 'add', '.')
+    if version > 2:
+        # an entry with extended flags, which version 2 can't hold
+        with open(os.path.join(clone, 'intent.txt'), 'w') as f:
+            f.write('intent\n')
+        git(clone, 'add', '-N', 'intent.txt')
+    git(clone, 'update-index', '--index-version', str(version))
+
+    index = gilded.gitindexfile(os.path.join(clone, '.git', 'index'))
+    assert index.version == version
+    expected = gitindexentries(clone)
+    assert list(index) == [path for path, stat in expected]
+    assert [(path, index.stat(path)) for path in index] == expected
+    assert 'z.txt' in index
+    assert 'subdir' not in index
+    with pytest.raises(KeyError):
+        index.stat('subdir')
+
+
+def test_index_written_once(clone, monkeypatch):
+    import gilded
+    import pygit2
+    from mercurial import ui as uimod
+    writes = []
+    write = pygit2.Index.write
+    monkeypatch.setattr(pygit2.Index, 'write',
+                        lambda self: writes.append(write(self)))
+    for i in range(10):
+        with open(os.path.join(clone, 'new%d.txt' % i), 'w') as f:
+            f.write('new\n')
+
+    repo = gilded.instance(uimod.ui.load(), clone, False)
+    with repo.wlock():
+        wctx = repo[None]
+        wctx.add(['new%d.txt' % i for i in range(10)])
+        wctx.forget(['file-A.txt'])
+        assert writes == []
+    assert len(writes) == 1
+    expected = ['A new%d.txt' % i for i in range(10)] + \
+        ['R file-A.txt', '? file-A.txt']
+    assert gitstatus(clone) == sorted(expected[:-1])
+    # nothing left to write
+    with repo.wlock():
+        repo.dirstate.write(repo.currenttransaction())
+    assert len(writes) == 1
+
+
+# -- Pack bitmaps
+
+BITMAP_REVSETS = [
+    "::master",
+    "::origin/branch2 - ::origin/branch1",
+    "only(master, origin/branch2)",
+    "ancestors(v1.0) and descendants(origin/branch1)",
+    "heads(::v1.1)",
+]
+
+
+def repack(repodir, reverseindex=False):
+    git(repodir, '-c', 'pack.writeReverseIndex=%s' % str(reverseindex).lower(),
+        'repack', '-q', '-adb')
+    packdir = os.path.join(repodir, '.git', 'objects', 'pack')
+    exts = set(os.path.splitext(name)[1] for name in os.listdir(packdir))
+    assert '.bitmap' in exts
+    assert ('.rev' in exts) == reverseindex
+
+
+@pytest.mark.parametrize('reverseindex', [False, True])
+def test_pack_bitmap(clone, reverseindex):
+    import gilded
+    from mercurial import ui as uimod
+    expected = [log(clone, revset) for revset in BITMAP_REVSETS]
+    repack(clone, reverseindex)
+    assert [log(clone, revset) for revset in BITMAP_REVSETS] == expected
+
+    repo = gilded.instance(uimod.ui.load(), clone, False)
+    index = repo.changelog.index
+    bitmap = index.bitmap
+    assert bitmap is not None and not bitmap.octopus
+    commits = git(clone, 'rev-list', '--all').split()
+    assert bin(bitmap.commits).count('1') == len(commits)
+    assert bitmap._selected
+    # each stored bitmap decodes to the ancestors git finds
+    for rev in bitmap._selected:
+        ancestors = git(clone, 'rev-list', index.node(rev).hex).split()
+        assert sorted(gilded._bitpositions(bitmap.ancestors([rev]))) == \
+            sorted(index.rev(gilded.pygit2.Oid(hex=node))
+                   for node in ancestors)
+
+
+def test_pack_bitmap_octopus(clone):
+    for name in ['side1', 'side2']:
+        git(clone, 'checkout', '-q', '-b', name, 'master~1')
+        git(clone, 'commit', '-q', '--allow-empty', '-m', name)
+    git(clone, 'checkout', '-q', 'master')
+    git(clone, 'merge', '-q', '--no-ff', '-m', 'octopus', 'side1', 'side2')
+    # like mercurial, only the first two parents are followed
+    expected = log(clone, "::master")
+    assert 'side1' in expected and 'side2' not in expected
+    repack(clone)
+    assert log(clone, "::master") == expected
+
+
+def test_descendants(clone):
+    import gilded
+    from mercurial import scmutil, ui as uimod
+    repo = gilded.instance(uimod.ui.load(), clone, False)
+    cl = repo.changelog
+    a = scmutil.revsymbol(repo, 'origin/branch1').rev()
+    b, = repo.revs('children(%d)', a)
+    expected = list(repo.revs('descendants(%d) - %d', a, a))
+    assert b in expected
+    assert list(cl.descendants([a])) == expected
+    # b is a seed, but also a descendant of a
+    assert list(cl.descendants([a, b])) == expected
+    assert list(cl.descendants([b])) == list(repo.revs('descendants(%d) - %d', b, b))
+
+
+def test_incoming_outgoing_diverged(clone, tmpdir):
+    other = str(tmpdir.join('other'))
+    subprocess.check_call(['git', 'clone', '-q', clone, other])
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'theirs')
+    for desc in ['ours 1', 'ours 2']:
+        git(other, 'commit', '-q', '--allow-empty', '-m', desc)
+    template = ['-q', '--template', '{desc}\n']
+    assert hg(other, 'outgoing', *template).splitlines() == ['ours 1',
+                                                            'ours 2']
+    assert hg(other, 'incoming', *template).splitlines() == ['theirs']
+    assert hg(other, 'summary', '--remote').splitlines()[-1] == \
+        'remote: 1 or more incoming, 2 outgoing'
+    # the repository compared with is only read
+    assert not os.path.exists(os.path.join(clone, '.git', 'gilded'))
+
+
+def test_branchmap(clone):
+    import gilded
+    from mercurial import ui as uimod
+    repo = gilded.instance(uimod.ui.load(), clone, False)
+
+    def rev(name):
+        return gilded.pygit2.Oid(hex=git(clone, 'rev-parse', name).strip())
+
+    assert repo.branchmap() == {'master': [rev('master')]}
+    git(clone, 'branch', 'other', 'master~1')
+    assert repo.branchmap() == {'master': [rev('master')],
+                                'other': [rev('master~1')]}
+    # a loose ref keeps its size
+    git(clone, 'update-ref', 'refs/heads/other', 'master~2')
+    assert repo.branchmap()['other'] == [rev('master~2')]
+    git(clone, 'pack-refs', '--all')
+    assert repo.branchmap()['other'] == [rev('master~2')]
+    # read back from the cache by another command
+    assert log(clone, "head() and branch(other)", template="{node}\n") == \
+        [rev('master~2').hex]
@@ -28,19 +28,29 @@ class BaseRunner(object):
     def __init__(self, datadir):
         self.repodir = os.path.join(datadir, self.name + 'test')
 
-    def log(self, revset, template=None, filter=None):
+    def log(self, revset, template=None, filter=None, config=()):
         if template is None:
             template = "{desc}\n"
+        args = []
+        for item in config:
+            args.extend(['--config', item])
         output = subprocess.check_output(
             self.exe + ['log', '-r', revset, '--template', template,
                         '--traceback',
-                        '-R', self.repodir])
+                        '-R', self.repodir] + args)
         return output.splitlines()
 
+    def exchange(self, command, repodir, path, rev):
+        output = subprocess.check_output(
+            self.exe + [command, path, '-r', rev, '--template', '{desc}\n',
+                        '--quiet', '--traceback', '-R', repodir])
+        return filtertags(output.splitlines())
+
 
 class GitRunner(BaseRunner):
     name = 'git'
     exe = ['hg', '--config', 'extensions.gilded=']
+    init = ['git', 'init', '-q']
     master = 'master'
     refs = {
         'branch1': 'ff2e4709adb23622f65f3a19c14bdcb40f988b55',
@@ -87,6 +97,7 @@ class GitRunner(BaseRunner):
 class HgRunner(BaseRunner):
     name = 'hg'
     exe = ['hg']
+    init = ['hg', 'init']
     master = 'default'
     refs = {
         'branch1': 'd3f9491a31d3912b11c4d4864bda16c380265a63',
@@ -99,8 +110,8 @@ class HgRunner(BaseRunner):
         ]
     }
 
-    def log(self, revset, template=None, filter=True):
-        lines = super(HgRunner, self).log(revset, template)
+    def log(self, revset, template=None, filter=True, config=()):
+        lines = super(HgRunner, self).log(revset, template, config=config)
         if filter:
             return filtertags(lines)
         else:
@@ -120,10 +131,26 @@ def repo(request):
     yield runner
 
 
+@pytest.fixture(params=[False, True], ids=['scan', 'textindex'])
+def textindex(request):
+    # the config is only read by gilded
+    yield ['gilded.text-index=%s' % request.param]
+
+
 def test_predicate_all(repo):
     assert set(repo.log("all()")) == set(repo.all)
 
 
+def test_predicate_ancestor(repo):
+    assert repo.log("ancestor(branch1, branch2)") == [
+        'add file-D',
+    ]
+
+    assert repo.log("ancestor(v1.0, {}, branch2)".format(repo.master)) == [
+        'modify file-A',
+    ]
+
+
 def test_predicate_ancestors(repo):
     assert repo.log("ancestors('branch1')") == [
         'initial commit',
@@ -132,6 +159,18 @@ def test_predicate_ancestors(repo):
         'add file-D',
     ]
 
+    assert repo.log("ancestors('branch1', depth=1)") == [
+        'modify file-A again',
+        'add file-D',
+    ]
+
+    assert repo.log("_firstancestors('branch1')") == [
+        'initial commit',
+        'modify file-A',
+        'modify file-A again',
+        'add file-D',
+    ]
+
 
 def test_predicate_branch(repo):
     assert repo.log("branch('branch1')") == repo.branch_commits['branch1']
@@ -148,11 +187,17 @@ def test_predicate_branch(repo):
     assert set(repo.log("branch(p1('branch1'))")) == result
 
 
-@pytest.mark.skip("object of type 'gitchangelog' has no len()")
 def test_predicate_branchpoint(repo):
-    assert repo.log("branchpoint()") == [
-        'merge branch1',
-    ]
+    if repo.name == 'git':
+        assert repo.log("branchpoint()") == [
+            'modify file-A',
+            'merge branch1',
+        ]
+    else:
+        # the hg branchpoint is a tag commit which gets filtered
+        assert repo.log("branchpoint()") == [
+            'merge branch1',
+        ]
 
 
 def test_predicate_children(repo):
@@ -161,8 +206,30 @@ def test_predicate_children(repo):
     ]
 
 
-def test_predicate_desc(repo):
-    assert set(repo.log("desc('modify ')")) == {
+def test_predicate_date(repo):
+    assert repo.log("date('<2018-08-31 12:15 -0700')") == [
+        'initial commit',
+        'modify file-A',
+    ]
+
+
+def test_predicate_descendants(repo):
+    assert set(repo.log("descendants(branch1)")) == {
+        'add file-D',
+        'merge branch1',
+        'modify file-C',
+        'remove file-B',
+        'modify file-D',
+    }
+
+    assert repo.log("descendants(branch1, depth=1)") == [
+        'add file-D',
+        'merge branch1',
+    ]
+
+
+def test_predicate_desc(repo, textindex):
+    assert set(repo.log("desc('modify ')", config=textindex)) == {
         'modify file-A',
         'modify file-A again',
         'modify file-B',
@@ -170,6 +237,39 @@ def test_predicate_desc(repo):
         'modify file-D',
     }
 
+    assert repo.log("desc('MODIFY FILE-A')", config=textindex) == [
+        'modify file-A',
+        'modify file-A again',
+    ]
+
+    assert repo.log("desc('re:^remove file')", config=textindex) == [
+        'remove file-B',
+    ]
+
+    # no literal text to look up
+    assert set(repo.log("desc('re:^(add|remove) ')", config=textindex)) == {
+        'add file-D',
+        'remove file-B',
+    }
+
+    # across the end of one message and the start of the next
+    assert repo.log("desc('file-A\\nmodify')", config=textindex) == []
+
+
+def test_predicate_grep(repo, textindex):
+    assert set(repo.log("grep(r'file-[BC]$')", config=textindex)) == {
+        'modify file-B',
+        'modify file-C',
+        'remove file-B',
+    }
+
+    # no literal text to look up
+    assert set(repo.log("grep(r'[BC]$')", config=textindex)) == {
+        'modify file-B',
+        'modify file-C',
+        'remove file-B',
+    }
+
 
 def test_predicate_head(repo):
     # default branch has a tag commit which gets filtered
@@ -203,12 +303,33 @@ def test_predicate_merge(repo):
     ]
 
 
+def test_predicate_keyword(repo, textindex):
+    assert repo.log("keyword('AGAIN')", config=textindex) == [
+        'modify file-A again',
+    ]
+
+    # too short to look up, and in every user name
+    assert set(repo.log("keyword('ad')", config=textindex)) == set(repo.all)
+
+
 def test_predicate_limit(repo):
     assert repo.log("limit(sort(v1.0::v1.1, date))") == [
         'modify file-A',
     ]
 
 
+def test_predicate_only(repo):
+    assert repo.log("only(branch2, branch1)") == [
+        'modify file-B',
+        'merge branch1',
+        'modify file-C',
+    ]
+
+    assert repo.log("branch2 % branch1") == repo.log("only(branch2, branch1)")
+
+    assert repo.log("only(branch1, branch2)") == []
+
+
 def test_predicate_parents(repo):
     assert repo.log("p1(branch1)") == [
         'modify file-A again',
@@ -249,6 +370,26 @@ def test_predicate_tag(repo):
 
 def test_predicate_user(repo):
     assert set(repo.log("user('Chad')")) == set(repo.all)
+    assert repo.log("reverse(user('Chad'))") == \
+        repo.log("reverse(all())")
+    assert repo.log("user('nobody')") == []
+
+
+def test_incoming_outgoing(repo, tmpdir):
+    other = str(tmpdir.join('other'))
+    subprocess.check_call(repo.init + [other])
+    branch1 = [
+        'initial commit',
+        'modify file-A',
+        'modify file-A again',
+        'add file-D',
+    ]
+
+    assert repo.exchange('outgoing', repo.repodir, other, 'branch1') == \
+        branch1
+
+    assert repo.exchange('incoming', other, repo.repodir, 'branch1') == \
+        branch1
 
 
 def test_complex(repo):
@@ -294,6 +435,23 @@ def test_booleans(repo):
     assert repo.log("desc('EMPTY') and v1.0") == []
 
 
+def test_set_algebra(repo):
+    assert repo.log("::branch1 and ::{}".format(repo.master)) == [
+        'initial commit',
+        'modify file-A',
+        'modify file-A again',
+        'add file-D',
+    ]
+
+    assert repo.log(
+        "ancestors({}) - ancestors(branch1) and merge()".format(repo.master)
+    ) == [
+        'merge branch1',
+    ]
+
+    assert repo.log("::branch1 and heads(all())") == []
+
+
 def test_revrange(repo):
     # git and hg choose different parent order
     assert set(repo.log("v1.0::v1.1")) == {
@@ -307,6 +465,15 @@ def test_revrange(repo):
 
     assert repo.log("v1.0::limit(desc('EMPTY'))") == []
 
+    assert set(repo.log("(v1.0 or branch1)::v1.1")) == {
+        'modify file-A',
+        'modify file-A again',
+        'add file-D',
+        'modify file-B',
+        'merge branch1',
+        'remove file-B'
+    }
+
 
 def test_revspecs(repo):
     assert repo.log(repo.refs['v1.0']) == [
@@ -321,3 +488,20 @@ def test_template_node(repo):
     assert repo.log("tag('v1.0')", "{node}\n") == [
         repo.refs['v1.0'],
     ]
+
+
+def test_template_tags(repo):
+    assert set(repo.log("tag()", "{tags}\n")) == {
+        'v1.0',
+        'v1.1',
+    }
+
+
+def test_template_rev(repo):
+    lines = repo.log("all()", "{rev} {p1rev} {p2rev}\n")
+    revs = [[int(x) for x in line.split()] for line in lines]
+    assert [r[0] for r in revs] == sorted(r[0] for r in revs)
+    for rev, p1, p2 in revs:
+        assert p1 < rev and p2 < rev
+    # revision numbers are stable from one command to the next
+    assert repo.log("all()", "{rev} {p1rev} {p2rev}\n") == lines